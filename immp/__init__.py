@@ -1,12 +1,14 @@
+from .core.cache import BoundCachedMethod, CachedMethod, cached
 from .core.channel import Channel, Group
 from .core.error import ConfigError, HookError, PlugError
 from .core.host import Host
 from .core.message import File, Location, Message, Receipt, RichText, Segment, SentMessage, User
 from .core.hook import Hook, ResourceHook
+from .core.markup import InlineMarkup
 from .core.plug import Plug
 from .core.schema import (Any, Invalid, JSONSchema, Nullable, Optional, Schema, SchemaError,
                           Validator, Walker)
 from .core.stream import PlugStream
 from .core.util import (escape, pretty_str, resolve_import, unescape, ConfigProperty,
-                        Configurable, HTTPOpenable, IDGen, LocalFilter, OpenState, Openable,
-                        Watchable, WatchedDict, WatchedList)
+                        Configurable, HTTPOpenable, IDGen, LocalFilter, LRUCache, OpenState,
+                        Openable, TokenBucket, Watchable, WatchedDict, WatchedList)
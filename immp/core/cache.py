@@ -0,0 +1,162 @@
+from asyncio import current_task, ensure_future, shield
+from functools import update_wrapper
+
+from .channel import Channel
+from .message import User
+from .util import LRUCache
+
+
+def _key(arg):
+    # Channel sources may be updated in-place (e.g. following a migration), and users may be
+    # recreated for each message, so identify both by their current identifiers.
+    if isinstance(arg, Channel):
+        return (Channel, arg.source)
+    elif isinstance(arg, User):
+        return (User, arg.id)
+    else:
+        return arg
+
+
+class CachedMethod:
+    """
+    Descriptor for async methods, typically lookups on a :class:`.Plug`, that caches results for
+    each instance and set of arguments.  Concurrent calls with the same arguments share a single
+    underlying call, and exceptions are never cached.
+
+    When accessed from an instance, this returns a :class:`BoundCachedMethod`, which can be called
+    like the original method, but also allows the cache to be invalidated::
+
+        class ExamplePlug(immp.Plug):
+
+            @immp.cached(size=1000, ttl=600)
+            async def channel_title(self, channel):
+                ...
+
+            def on_rename(self, channel):
+                self.channel_title.invalidate(channel)
+
+    Attributes:
+        method (function):
+            Underlying async method.
+        size (int):
+            Maximum number of results to hold per instance, or ``None`` for no limit.
+        ttl (float):
+            Number of seconds to hold each result for, or ``None`` to hold indefinitely.
+        negative (bool):
+            ``True`` to cache ``None`` results, e.g. a failed lookup of an unknown user.
+    """
+
+    def __init__(self, method, size=None, ttl=None, negative=True):
+        update_wrapper(self, method)
+        self.method = method
+        self.size = size
+        self.ttl = ttl
+        self.negative = negative
+        self._attr = "_cached_{}".format(method.__name__)
+
+    def __set_name__(self, owner, name):
+        self._attr = "_cached_{}".format(name)
+
+    def _store(self, instance):
+        # Pair of (cached results, pending calls) for this instance.
+        try:
+            return getattr(instance, self._attr)
+        except AttributeError:
+            store = (LRUCache(self.size, self.ttl), {})
+            setattr(instance, self._attr, store)
+            return store
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return BoundCachedMethod(self, instance)
+
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__, self.method.__qualname__)
+
+
+class BoundCachedMethod:
+    """
+    Instance-specific accessor for a :class:`CachedMethod`.
+    """
+
+    __slots__ = ("_cached", "_instance")
+
+    def __init__(self, cached, instance):
+        self._cached = cached
+        self._instance = instance
+
+    @staticmethod
+    def _make_key(args, kwargs):
+        return (tuple(_key(arg) for arg in args),
+                tuple(sorted((name, _key(arg)) for name, arg in kwargs.items())))
+
+    async def _fetch(self, key, args, kwargs):
+        results, pending = self._cached._store(self._instance)
+        try:
+            result = await self._cached.method(self._instance, *args, **kwargs)
+        finally:
+            # If invalidated whilst in progress, this call is no longer the current one.
+            current = pending.get(key) is current_task()
+            if current:
+                del pending[key]
+        if current and (result is not None or self._cached.negative):
+            results[key] = result
+        return result
+
+    async def __call__(self, *args, **kwargs):
+        try:
+            key = self._make_key(args, kwargs)
+            hash(key)
+        except TypeError:
+            # Unhashable arguments, bypass the cache.
+            return await self._cached.method(self._instance, *args, **kwargs)
+        results, pending = self._cached._store(self._instance)
+        try:
+            return results[key]
+        except KeyError:
+            pass
+        try:
+            fetch = pending[key]
+        except KeyError:
+            fetch = pending[key] = ensure_future(self._fetch(key, args, kwargs))
+        # Don't cancel the shared call if just this caller is cancelled.
+        return await shield(fetch)
+
+    def invalidate(self, *args, **kwargs):
+        """
+        Discard any cached result for the given arguments.
+        """
+        results, pending = self._cached._store(self._instance)
+        key = self._make_key(args, kwargs)
+        results.pop(key, None)
+        pending.pop(key, None)
+
+    def clear(self):
+        """
+        Discard all cached results for this instance.
+        """
+        results, pending = self._cached._store(self._instance)
+        results.clear()
+        pending.clear()
+
+    def __repr__(self):
+        return "<{}: {} {!r}>".format(self.__class__.__name__, self._cached.method.__qualname__,
+                                      self._instance)
+
+
+def cached(size=None, ttl=None, negative=True):
+    """
+    Decorator to create a :class:`.CachedMethod` from an async method.
+
+    Args:
+        size (int):
+            Maximum number of results to hold per instance, or ``None`` for no limit.
+        ttl (float):
+            Number of seconds to hold each result for, or ``None`` to hold indefinitely.
+        negative (bool):
+            ``True`` (default) to cache ``None`` results, ``False`` to retry them on each call.
+    """
+    def inner(method):
+        return CachedMethod(method, size, ttl, negative)
+    return inner
@@ -160,6 +160,24 @@ class Channel:
         """
         return await self.plug.channel_history(self, before)
 
+    def iter_history(self, before=None, limit=None, since=None):
+        """
+        Equivalent to :meth:`.Plug.channel_iter_history`.
+
+        Args:
+            before (.Receipt):
+                Starting point message, or ``None`` to start from the most recent.
+            limit (int):
+                Maximum number of messages to retrieve, or ``None`` for no limit.
+            since (datetime.datetime):
+                Timezone-aware timestamp at which to stop, or ``None`` for no limit.
+
+        Returns:
+            .SentMessage async iterator:
+                Messages from the channel, newest first.
+        """
+        return self.plug.channel_iter_history(self, before, limit, since)
+
     async def send(self, msg):
         """
         Push a message to the related plug on this channel.  Equivalent to :meth:`.Plug.send`.
@@ -0,0 +1,197 @@
+import re
+
+
+class InlineMarkup:
+    """
+    Single-pass parser for the inline formatting used by Markdown-like message syntaxes, to be
+    configured by plugs with the tags of their network.
+
+    Formatting tags are matched according to the following rules:
+
+    1) Outside of formatting may not be adjacent to alphanumeric or other formatting characters.
+    2) Inside of formatting may not be adjacent to whitespace.
+    3) Formatting characters may be escaped with a backslash.
+    4) Formatting may not span multiple lines, and isn't applied inside code.
+    5) Runs of adjacent formatting characters (e.g. ``***``) are split into the longest matching
+       tags, so may open or close several formats at once.
+
+    This still isn't perfect, but provides a good approximation outside of edge cases.
+
+    Attributes:
+        tags ((str, str) dict):
+            Mapping from inline formatting tags (e.g. ``**``) to :class:`.Segment` attributes (e.g.
+            ``bold``).  Where tags overlap, the longest is matched first.
+        entities (re.Pattern):
+            Optional expression to match other markup (e.g. mentions or links) that should be
+            passed through as-is, and in which formatting characters are ignored.
+        pre (re.Pattern):
+            Optional expression to match preformatted blocks, whose first group holds the content.
+            Formatting isn't parsed within these blocks, though entities are.
+        outside (str):
+            Characters which may not appear directly outside of formatting tags.
+        literal (str set):
+            Formatting attributes inside of which other formatting isn't parsed.
+    """
+
+    outside_chars = "0123456789abcdefghijklmnopqrstuvwxyz*_~"
+
+    def __init__(self, tags, entities=None, pre=None, outside=outside_chars, literal=("code",)):
+        self.tags = tags
+        self.entities = re.compile(entities) if isinstance(entities, str) else entities
+        self.pre = re.compile(pre, re.DOTALL) if isinstance(pre, str) else pre
+        self.outside = frozenset(outside)
+        self.literal = frozenset(literal)
+        self._longest = sorted(tags, key=len, reverse=True)
+        # Combine everything into one expression to visit each token once, in order.  Adjacent
+        # formatting characters form a single delimiter run, e.g. "***" or "*_", which is then
+        # split into individual tags.
+        chars = "".join(sorted(set("".join(tags))))
+        tokens = ["[{}]+".format(re.escape(chars)), r"\n"]
+        if self.entities:
+            tokens.insert(0, "(?:{})".format(self.entities.pattern))
+        flags = self.entities.flags if self.entities else 0
+        self._token_regex = re.compile("|".join(tokens), flags)
+
+    def _split(self, run, pos):
+        # Break a delimiter run into tags, taking the longest available tag at each position.
+        for tag in self._longest:
+            if run.startswith(tag, pos):
+                return tag
+        return None
+
+    def _split_open(self, run, pos, opened):
+        # As above, but only for tags that are currently open.
+        for tag in self._longest:
+            if opened[tag] and run.startswith(tag, pos):
+                return tag
+        return None
+
+    @staticmethod
+    def _pop(stack, opened, tag):
+        # Tags opened by the same run (e.g. "***" as "**" and "*") sit at the same position, so
+        # can be closed in any order.  Otherwise, anything opened since the tag is left unmatched.
+        # The innermost opener of each tag is looked up by its stack position, and openers closed
+        # out of order are blanked rather than removed, so the stack is never searched or shifted.
+        index = opened[tag].pop()
+        _, opener, group = stack[index]
+        if group == stack[-1][2]:
+            stack[index] = None
+        else:
+            while len(stack) > index:
+                entry = stack.pop()
+                if entry and entry[0] != tag:
+                    opened[entry[0]].pop()
+        while stack and not stack[-1]:
+            stack.pop()
+        return opener
+
+    def _scan(self, text, tokens, start, end, pre=False):
+        # Append [position, length, action] for each entity and each matched pair of formatting
+        # tags in the range.  Openers are added as placeholders and filled in once closed, so the
+        # list stays in text order; any left unfilled are unmatched and treated as plain text.
+        # Each opener is pushed and popped at most once, and the stack positions of open tags are
+        # indexed so that a closing tag can find its opener without searching.
+        stack = []
+        opened = {tag: [] for tag in self.tags}
+        for token in self._token_regex.finditer(text, start, end):
+            pos = token.start()
+            run = token.group()
+            entity = self.entities.match(text, pos, end) if self.entities else None
+            if entity and entity.end() == token.end():
+                tokens.append([pos, len(run), ("entity", entity)])
+                continue
+            elif pre:
+                continue
+            elif run == "\n":
+                stack.clear()
+                opened = {tag: [] for tag in self.tags}
+                continue
+            before = text[pos - 1] if pos > start else ""
+            after = text[token.end()] if token.end() < end else ""
+            if before == "\\":
+                # Escaped, leave the whole run as text.
+                continue
+            index = 0
+            if before and not before.isspace() and after not in self.outside:
+                # Close any open tags, innermost first, that this run starts with.
+                while index < len(run) and stack:
+                    tag, opener, _ = stack[-1]
+                    if self.tags[tag] in self.literal:
+                        # Only the matching tag can end literal formatting, wherever it is in
+                        # the run, e.g. "*`" ending "`code *x*`".
+                        index = run.find(tag, index)
+                        if index < 0:
+                            break
+                    else:
+                        tag = self._split_open(run, index, opened)
+                        if not tag:
+                            break
+                    opener = self._pop(stack, opened, tag)
+                    field = self.tags[tag]
+                    opener[2] = ("format", field, True)
+                    tokens.append([pos + index, len(tag), ("format", field, False)])
+                    index += len(tag)
+            if stack and self.tags[stack[-1][0]] in self.literal:
+                continue
+            if before not in self.outside and after and not after.isspace():
+                # Open tags for the remainder of the run.
+                while index < len(run):
+                    tag = self._split(run, index)
+                    if not tag:
+                        break
+                    opener = [pos + index, len(tag), None]
+                    tokens.append(opener)
+                    opened[tag].append(len(stack))
+                    stack.append((tag, opener, pos))
+                    index += len(tag)
+                    if self.tags[tag] in self.literal:
+                        break
+
+    def parse(self, text):
+        """
+        Split a formatted string into runs of text with consistent formatting, and entities.
+
+        Args:
+            text (str):
+                Formatted text to parse.
+
+        Returns:
+            (str, (str, bool) dict, re.Match) tuple list:
+                Runs of text in order, each with the formatting that applies to it, and a match
+                object from :attr:`entities` if the run is an entity rather than plain text.
+        """
+        tokens = []
+        last = 0
+        if self.pre:
+            for match in self.pre.finditer(text):
+                self._scan(text, tokens, last, match.start())
+                tokens.append([match.start(), match.start(1) - match.start(),
+                               ("format", "pre", True)])
+                self._scan(text, tokens, match.start(1), match.end(1), True)
+                tokens.append([match.end(1), match.end() - match.end(1), ("format", "pre", False)])
+                last = match.end()
+        self._scan(text, tokens, last, len(text))
+        runs = []
+        formatting = {}
+        # The same attribute may be opened more than once (e.g. Slack's "**bold**").
+        depth = {}
+        last = 0
+        for pos, length, action in tokens:
+            if not action:
+                # Unmatched formatting tag, leave it in the text.
+                continue
+            if pos > last:
+                runs.append((text[last:pos], dict(formatting), None))
+            last = pos + length
+            if action[0] == "format":
+                field = action[1]
+                depth[field] = depth.get(field, 0) + (1 if action[2] else -1)
+                formatting[field] = depth[field] > 0
+            else:
+                runs.append((action[1].group(), dict(formatting), action[1]))
+        if last < len(text):
+            runs.append((text[last:], dict(formatting), None))
+        return runs
+
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__, " ".join(self.tags))
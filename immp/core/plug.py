@@ -1,9 +1,10 @@
-from asyncio import BoundedSemaphore, Queue
+from asyncio import BoundedSemaphore, Queue, ensure_future
 import logging
 
+from .cache import BoundCachedMethod
 from .error import PlugError
-from .message import Message, Receipt
-from .util import Configurable, Openable, OpenState, pretty_str
+from .message import Message, Receipt, SentMessage
+from .util import Configurable, LRUCache, Openable, OpenState, pretty_str
 
 
 log = logging.getLogger(__name__)
@@ -38,6 +39,10 @@ class Plug(Configurable, Openable):
 
     network_name = network_id = None
 
+    # Number of recent messages to keep for :meth:`resolve_message`, and how long to keep them.
+    message_cache_size = 1000
+    message_cache_ttl = 60 * 60
+
     def __init__(self, name, config, host, virtual=False):
         super().__init__(name, config, host)
         self.virtual = virtual
@@ -48,6 +53,9 @@ class Plug(Configurable, Openable):
         # Message history, to match up received messages with their sent sources.
         # Mapping from (channel, message ID) to (source message, all IDs).
         self._sent = {}
+        # Recently received and sent messages, to resolve receipts (e.g. replies) without a lookup.
+        # Mapping from (channel, message ID) to the latest revision of the message.
+        self._messages = LRUCache(self.message_cache_size, self.message_cache_ttl)
         # Hook lock, to put a hold on retrieving messages whilst a send is in progress.
         self._lock = BoundedSemaphore()
 
@@ -158,6 +166,9 @@ class Plug(Configurable, Openable):
         Retrieve the friendly name of this channel, as used in the underlying network.  May return
         ``None`` if the service doesn't have a notion of titles.
 
+        Plugs that need to make network requests for this (and other lookups) may cache results
+        with :func:`.cached`.  Cached titles are discarded when a rename message is queued.
+
         Returns:
             str:
                 Display name for the channel.
@@ -327,6 +338,52 @@ class Plug(Configurable, Openable):
         """
         return []
 
+    async def channel_iter_history(self, channel, before=None, limit=None, since=None):
+        """
+        Iterate backwards through past messages in the given channel, newest first.  Unlike
+        :meth:`channel_history`, this continues across multiple batches of messages, and fetches
+        the next batch in the background whilst the current one is being consumed.
+
+        By default, this pages through :meth:`channel_history`, but plugs may override it to make
+        use of any native means of iterating history.
+
+        Args:
+            channel (.Channel):
+                Requested channel instance.
+            before (.Receipt):
+                Starting point message, or ``None`` to start from the most recent.
+            limit (int):
+                Maximum number of messages to retrieve, or ``None`` for no limit.
+            since (datetime.datetime):
+                Timezone-aware timestamp at which to stop, or ``None`` to continue until the start
+                of the channel's history.
+
+        Yields:
+            .SentMessage:
+                Messages from the channel, newest first.
+        """
+        count = 0
+        batch = await self.channel_history(channel, before)
+        while batch:
+            fetch = ensure_future(self.channel_history(channel, batch[0]))
+            try:
+                for sent in reversed(batch):
+                    if since and sent.at < since:
+                        return
+                    yield sent
+                    count += 1
+                    if limit and count >= limit:
+                        return
+                # Guard against plugs that return overlapping or repeated batches.
+                seen = {sent.id for sent in batch}
+                batch = [sent for sent in await fetch if sent.id not in seen]
+            finally:
+                if not fetch.done():
+                    fetch.cancel()
+                elif not fetch.cancelled():
+                    # Retrieve any exception from an abandoned fetch, to avoid warnings about it.
+                    fetch.exception()
+
     async def get_message(self, receipt):
         """
         Lookup a :class:`.Receipt` and fetch the corresponding :class:`.SentMessage`.
@@ -346,6 +403,9 @@ class Plug(Configurable, Openable):
         Lookup a :class:`.Receipt` if no :class:`.Message` data is present, and fetch the
         corresponding :class:`.SentMessage`.
 
+        Messages recently received or sent through this plug are returned from a local cache,
+        falling back to :meth:`get_message` for anything else.
+
         Args:
             msg (.Message | .Receipt):
                 Existing message reference to retrieve.
@@ -359,10 +419,25 @@ class Plug(Configurable, Openable):
         elif isinstance(msg, Message):
             return msg
         elif isinstance(msg, Receipt):
-            return await self.get_message(msg)
+            try:
+                return self._messages[(msg.channel, msg.id)]
+            except KeyError:
+                pass
+            sent = await self.get_message(msg)
+            if sent:
+                self._cache_message(sent)
+            return sent
         else:
             raise TypeError
 
+    def _cache_message(self, sent):
+        key = (sent.channel, sent.id)
+        if sent.deleted:
+            self._messages.pop(key, None)
+        else:
+            # Edits replace the cached copy, so that the latest revision is returned.
+            self._messages[key] = sent
+
     def queue(self, sent):
         """
         Add a new message to the queue, picked up from :meth:`get` by default.
@@ -371,6 +446,9 @@ class Plug(Configurable, Openable):
             sent (.SentMessage):
                 Message received and processed by the plug.
         """
+        if sent.title and isinstance(self.channel_title, BoundCachedMethod):
+            self.channel_title.invalidate(sent.channel)
+        self._cache_message(sent)
         self._queue.put_nowait(sent)
 
     def _lookup(self, sent):
@@ -465,6 +543,9 @@ class Plug(Configurable, Openable):
         ids = [receipt.id for receipt in receipts]
         for id_ in ids:
             self._sent[(channel, id_)] = (msg, ids)
+        for receipt in receipts:
+            if isinstance(receipt, SentMessage):
+                self._cache_message(receipt)
         return receipts
 
     async def put(self, channel, msg):
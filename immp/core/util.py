@@ -1,4 +1,5 @@
-from asyncio import Condition
+from asyncio import Condition, Lock, sleep
+from collections import OrderedDict
 from collections.abc import MutableMapping, MutableSequence
 from enum import Enum
 from functools import reduce, wraps
@@ -242,6 +243,75 @@ class WatchedList(list, Watchable):
         return super().extend([self._wrap(item) for item in other])
 
 
+class LRUCache(MutableMapping):
+    """
+    Mapping with an optional size limit, which evicts the least recently used items when full, and
+    an optional lifetime after which items expire.
+
+    Note that ``None`` is a valid cached value -- use ``key in cache`` or catch :class:`KeyError`
+    to distinguish a cached negative result from a missing item.
+
+    Attributes:
+        size (int):
+            Maximum number of items to hold, or ``None`` for no limit.
+        ttl (float):
+            Number of seconds after which an item expires, or ``None`` to hold items indefinitely.
+    """
+
+    __slots__ = ("size", "ttl", "_items")
+
+    def __init__(self, size=None, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        # Mapping from keys to (expiry, value) pairs, ordered from least to most recently used.
+        self._items = OrderedDict()
+
+    def _expired(self, expiry):
+        return expiry is not None and expiry < time.monotonic()
+
+    def __getitem__(self, key):
+        expiry, value = self._items[key]
+        if self._expired(expiry):
+            del self._items[key]
+            raise KeyError(key)
+        self._items.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        expiry = time.monotonic() + self.ttl if self.ttl else None
+        self._items[key] = (expiry, value)
+        self._items.move_to_end(key)
+        if self.size:
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def __iter__(self):
+        return iter([key for key, (expiry, _) in self._items.items()
+                     if not self._expired(expiry)])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def clear(self):
+        self._items.clear()
+
+    def __repr__(self):
+        return "<{}: {}{}{}>".format(self.__class__.__name__, len(self._items),
+                                     "/{}".format(self.size) if self.size else "",
+                                     " @ {}s".format(self.ttl) if self.ttl else "")
+
+
 class ConfigProperty:
     """
     Data descriptor to present config from :class:`.Openable` instances using the actual objects
@@ -335,6 +405,89 @@ class IDGen:
         return "<{}: {} -> {}>".format(self.__class__.__name__, self.last, self())
 
 
+class TokenBucket:
+    """
+    Rate limiter that permits short bursts of activity, up to a fixed capacity, whilst enforcing a
+    sustained rate over time.  Can be used in an ``async with`` statement to wait for a token before
+    proceeding.  Waiting callers are served in the order they arrived.
+
+    Attributes:
+        capacity (float):
+            Maximum number of tokens that can be held, i.e. the size of an allowed burst.
+        rate (float):
+            Number of tokens restored per second.
+        waiting (int):
+            Number of callers currently waiting to acquire a token.
+    """
+
+    __slots__ = ("capacity", "rate", "waiting", "_tokens", "_updated", "_lock")
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.waiting = 0
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    @property
+    def full(self):
+        """
+        ``True`` if the bucket is at capacity with no waiting callers, and therefore equivalent to
+        a newly created one.
+        """
+        return not self.waiting and self.tokens >= self.capacity
+
+    async def acquire(self):
+        """
+        Take a token from the bucket, waiting until one becomes available.
+        """
+        self.waiting += 1
+        try:
+            async with self._lock:
+                self._refill()
+                while self._tokens < 1:
+                    await sleep((1 - self._tokens) / self.rate)
+                    self._refill()
+                self._tokens -= 1
+        finally:
+            self.waiting -= 1
+
+    def pause(self, delay):
+        """
+        Empty the bucket such that no tokens will be available for the given duration, e.g. when
+        the remote side has signalled that a limit was exceeded.
+
+        Args:
+            delay (float):
+                Number of seconds to block further acquisitions.
+        """
+        self._refill()
+        self._tokens = min(self._tokens, 1 - (delay * self.rate))
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __repr__(self):
+        return "<{}: {:.1f}/{} @ {}/s{}>".format(self.__class__.__name__, self.tokens,
+                                                 self.capacity, self.rate,
+                                                 " +{}".format(self.waiting)
+                                                 if self.waiting else "")
+
+
 class LocalFilter(logging.Filter):
     """
     Logging filter that restricts capture to loggers within the ``immp`` namespace.
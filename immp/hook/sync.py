@@ -649,8 +649,9 @@ class SyncHook(_SyncHookBase):
         super().__init__(name, config, host)
         # Message cache, stores IDs of all synced messages by channel.
         self._cache = SyncCache(self)
-        # Hook lock, to put a hold on retrieving messages whilst a send is in progress.
-        self._lock = BoundedSemaphore()
+        # Per-bridge locks, to put a hold on retrieving messages whilst a send is in progress.
+        # Bridges don't share channels, so each can proceed independently of the others.
+        self._locks = defaultdict(BoundedSemaphore)
         # Add a virtual plug to the host, for external subscribers.
         if self.config["plug"]:
             log.debug("Creating virtual plug: %r", self.config["plug"])
@@ -769,8 +770,8 @@ class SyncHook(_SyncHookBase):
             queue.append(self._send(synced, local))
         # Just like with plugs, when sending a new (external) message to all channels in a sync, we
         # need to wait for all plugs to complete and have their IDs cached before processing any
-        # further messages.
-        async with self._lock:
+        # further messages for this bridge.
+        async with self._locks[label]:
             all_receipts = dict(await gather(*queue))
             ids = {channel: [receipt.id for receipt in receipts]
                    for channel, receipts in all_receipts.items()}
@@ -835,7 +836,7 @@ class SyncHook(_SyncHookBase):
             label = self.label_for_channel(sent.channel)
         except immp.ConfigError:
             return
-        async with self._lock:
+        async with self._locks[label]:
             # No critical section here, just wait for any pending messages to be sent.
             pass
         ref = None
@@ -48,13 +48,12 @@ via Edit Channel > Webhooks.  A fallback style incorporating the user's name in
 will be used in lieu of a webhook, e.g. with direct messages.
 """
 
-from asyncio import Condition, ensure_future, gather
-from collections import defaultdict
+from asyncio import Condition, ensure_future, gather, Semaphore
 from datetime import timezone
 from functools import partial
-from io import BytesIO
 import logging
 import re
+from tempfile import SpooledTemporaryFile
 
 import discord as discordpy
 from emoji import emojize
@@ -120,30 +119,16 @@ class DiscordRichText(immp.RichText):
     base_tags = {"**": "bold", "_": "italic", "__": "underline", "~~": "strike",
                  "`": "code", "```": "pre"}
     all_tags = dict({"*": "italic"}, **base_tags)
-    # A rather complicated expression to match formatting tags according to the following rules:
-    # 1) Outside of formatting may not be adjacent to alphanumeric or other formatting characters.
-    # 2) Inside of formatting may not be adjacent to whitespace or the current formatting character.
-    # 3) Formatting characters may be escaped with a backslash.
-    # This still isn't perfect, but provides a good approximation outside of edge cases.
-    _outside_chars = r"0-9a-z*_~"
-    _tag_chars = r"\*\*|__|~~|[*_`]"
-    _inside_chars = r"\s\1"
-    _format_regex = re.compile(r"(?<![{0}\\])({1})(?![{2}])(.+?)(?<![{2}\\])\1(?![{0}])"
-                               .format(_outside_chars, _tag_chars, _inside_chars))
-    _pre_regex = re.compile(r"```\n?(.+?)\n?```", re.DOTALL)
-
-    _mention_regex = re.compile(r"<@!?(\d+)>")
-    _role_mention_regex = re.compile(r"<@&(\d+)>")
-    _channel_regex = re.compile(r"<#(\d+)>")
-    _emoji_regex = re.compile(r"<(:[^: ]+?:)\d+>")
+    # Entities are user, role and channel mentions, and custom emoji.
+    _markup = immp.InlineMarkup({tag: attr for tag, attr in all_tags.items() if attr != "pre"},
+                                entities=r"<(?:(@!?|@&|#)(\d+)|a?(:[^: ]+?:)\d+)>",
+                                pre=r"```\n?(.+?)\n?```")
 
     @classmethod
-    def _sub_role_mention(cls, roles, match):
-        return "@{}".format(roles.get(int(match.group(1)), "&{}".format(match.group(1))))
-
-    @classmethod
-    def _sub_channel(cls, discord, match):
-        return "#{}".format(discord._client.get_channel(int(match.group(1))).name)
+    def _segment(cls, text, formatting):
+        if not (formatting.get("code") or formatting.get("pre")):
+            text = emojize(text, language="alias")
+        return immp.Segment(text, **formatting)
 
     @classmethod
     def from_message(cls, discord, message):
@@ -160,82 +145,42 @@ class DiscordRichText(immp.RichText):
             .DiscordRichText:
                 Parsed rich text container.
         """
-        text = message.content
-        changes = defaultdict(dict)
-        plain = ""
-        done = False
-        while not done:
-            # Identify pre blocks, parse formatting only outside of them.
-            match = cls._pre_regex.search(text)
-            if match:
-                parse = text[:match.start()]
-                pre = match.group(1)
-                text = text[match.end():]
-            else:
-                parse = text
-                done = True
-            offset = len(plain)
-            while True:
-                match = cls._format_regex.search(parse)
-                if not match:
-                    break
-                start = match.start()
-                end = match.end()
-                tag = match.group(1)
-                # Strip the tag characters from the message.
-                parse = parse[:start] + match.group(2) + parse[end:]
-                end -= 2 * len(tag)
-                # Record the range where the format is applied.
-                field = cls.all_tags[tag]
-                changes[offset + start][field] = True
-                changes[offset + end][field] = False
-                # Shift any future tags back.
-                for pos in sorted(changes):
-                    if pos > offset + end:
-                        changes[pos - 2 * len(tag)].update(changes.pop(pos))
-            plain += parse
-            if not done:
-                changes[len(plain)]["pre"] = True
-                changes[len(plain + pre)]["pre"] = False
-                plain += pre
         mentioned = {user.id: user for user in message.mentions}
-        for match in cls._mention_regex.finditer(plain):
-            id_ = int(match.group(1))
-            if id_ in mentioned:
-                user = mentioned[id_]
-            else:
-                user = mentioned[id_] = discord._client.get_user(id_)
-            if user:
-                changes[match.start()]["mention"] = DiscordUser.from_user(discord, user)
-                changes[match.end()]["mention"] = None
-        segments = []
-        points = list(sorted(changes.keys()))
-        formatting = {}
         roles = {role.id: role.name for role in message.role_mentions}
-        # Iterate through text in change start/end pairs.
-        for start, end in zip([0] + points, points + [len(plain)]):
-            formatting.update(changes[start])
-            if start == end:
-                # Zero-length segment at the start or end, ignore it.
+        segments = []
+        for part, formatting, match in cls._markup.parse(message.content):
+            if not match:
+                segments.append(cls._segment(part, formatting))
                 continue
-            if formatting.get("mention"):
-                user = formatting["mention"]
-                part = "@{}".format(user.real_name or user.username)
+            kind, id_, emoji = match.groups()
+            if emoji:
+                # Custom emoji can't be represented elsewhere, just show the name.
+                segments.append(immp.Segment(emoji, **formatting))
+            elif kind == "#":
+                dc_channel = discord._client.get_channel(int(id_))
+                name = dc_channel.name if dc_channel else id_
+                segments.append(immp.Segment("#{}".format(name), **formatting))
+            elif kind == "@&":
+                name = roles.get(int(id_), "&{}".format(id_))
+                segments.append(immp.Segment("@{}".format(name), **formatting))
             else:
-                part = emojize(plain[start:end], language="alias")
-                # Strip Discord channel/emoji tags, replace with a plain text representation.
-                part = cls._role_mention_regex.sub(partial(cls._sub_role_mention, roles), part)
-                part = cls._channel_regex.sub(partial(cls._sub_channel, discord), part)
-                part = cls._emoji_regex.sub(r"\1", part)
-            segments.append(immp.Segment(part, **formatting))
+                if int(id_) in mentioned:
+                    user = mentioned[int(id_)]
+                else:
+                    user = mentioned[int(id_)] = discord._client.get_user(int(id_))
+                if user:
+                    user = DiscordUser.from_user(discord, user)
+                    segments.append(immp.Segment("@{}".format(user.real_name or user.username),
+                                                 mention=user, **formatting))
+                else:
+                    segments.append(immp.Segment(part, **formatting))
         return cls(segments)
 
+    _emoji_regex = re.compile(r":([^: ]+):")
+
     @classmethod
-    def _sub_emoji(cls, discord, match):
-        for emoji in discord._client.emojis:
-            if emoji.name == match.group(1):
-                return str(emoji)
-        return ":{}:".format(match.group(1))
+    def _sub_emoji(cls, emojis, match):
+        return emojis.get(match.group(1)) or match.group()
 
     @classmethod
     def to_markdown(cls, discord, rich):
@@ -287,7 +232,10 @@ class DiscordRichText(immp.RichText):
         for tag in reversed(active):
             # Close all remaining tags.
             text += tag
-        return re.sub(r":([^: ]+):", partial(cls._sub_emoji, discord), text)
+        if discord._emojis and ":" in text:
+            # Replace all custom emoji names in one pass, using the plug's index.
+            text = cls._emoji_regex.sub(partial(cls._sub_emoji, discord._emojis), text)
+        return text
 
 
 class DiscordMessage(immp.Message):
@@ -323,7 +271,7 @@ class DiscordMessage(immp.Message):
         if message.reference and not message.flags.is_crossposted:
             receipt = immp.Receipt(message.reference.message_id,
                                    immp.Channel(discord, message.reference.channel_id))
-            reply_to = await discord.get_message(receipt)
+            reply_to = await discord.resolve_message(receipt)
         for attach in message.attachments:
             if attach.filename.endswith((".jpg", ".png", ".gif")):
                 type_ = immp.File.Type.image
@@ -419,12 +367,22 @@ class DiscordClient(discordpy.Client):
     on_disconnect = on_connect
 
     async def on_ready(self):
+        self._plug._index_emojis()
         await self.on_resume()
 
     async def on_resume(self):
         if self._plug.config["playing"]:
             await self.change_presence(activity=discordpy.Game(self._plug.config["playing"]))
 
+    async def on_guild_emojis_update(self, guild, before, after):
+        log.debug("Received updated emoji for guild %r", guild.id)
+        self._plug._index_emojis()
+
+    async def on_guild_available(self, guild):
+        self._plug._index_emojis()
+
+    on_guild_join = on_guild_remove = on_guild_unavailable = on_guild_available
+
     async def on_message(self, message):
         log.debug("Received a new message")
         self._plug.queue(await DiscordMessage.from_message(self._plug, message))
@@ -450,6 +408,13 @@ class DiscordPlug(immp.Plug, immp.HTTPOpenable):
 
     network_name = "Discord"
 
+    # Number of attachments to download at once.
+    _fetch_limit = 4
+    # Size in bytes above which downloaded attachments are written to a temporary file.
+    _spill_size = 4 * 1024 * 1024
+    # Upload limit in bytes for direct messages, where there's no guild to check.
+    _upload_limit = 25 * 1024 * 1024
+
     @property
     def network_id(self):
         return ("discord:{}".format(self._client.user.id)
@@ -460,6 +425,15 @@ class DiscordPlug(immp.Plug, immp.HTTPOpenable):
         # Connection objects that need to be closed on disconnect.
         self._client = self._task = None
         self._starting = Condition()
+        # Mapping from named channels to webhook URLs, along with the config and host state used to
+        # build it, so it can be rebuilt when either changes.
+        self._webhook_key = None
+        self._webhook_urls = {}
+        # Webhook objects by URL, bound to the current session.
+        self._webhooks = {}
+        self._fetching = Semaphore(self._fetch_limit)
+        # Mapping from custom emoji names to their Markdown representations.
+        self._emojis = {}
 
     async def start(self):
         await super().start()
@@ -482,10 +456,33 @@ class DiscordPlug(immp.Plug, immp.HTTPOpenable):
             log.debug("Closing client")
             await self._client.close()
             self._client = None
+        self._webhooks.clear()
+        self._emojis = {}
+        self._fetch_user.clear()
+
+    def _index_emojis(self):
+        emojis = {}
+        for emoji in self._client.emojis:
+            # Where names are shared across guilds, prefer the first one found.
+            emojis.setdefault(emoji.name, str(emoji))
+        self._emojis = emojis
+        log.debug("Indexed %d custom emoji", len(emojis))
 
     async def user_from_id(self, id_):
-        user = await self._client.fetch_user(id_)
-        return DiscordUser.from_user(self, user) if user else None
+        # Users we share a guild with are kept up-to-date by the gateway, so only cache lookups of
+        # anyone else from the API.
+        user = self._client.get_user(int(id_))
+        if user:
+            return DiscordUser.from_user(self, user)
+        return await self._fetch_user(id_)
+
+    @immp.cached(1000, 60 * 60)
+    async def _fetch_user(self, id_):
+        try:
+            user = await self._client.fetch_user(id_)
+        except discordpy.NotFound:
+            return None
+        return DiscordUser.from_user(self, user)
 
     async def user_from_username(self, username):
         for guild in self._client.guilds:
@@ -596,50 +593,81 @@ class DiscordPlug(immp.Plug, immp.HTTPOpenable):
         message = await dc_channel.fetch_message(receipt.id)
         return await DiscordMessage.from_message(self, message)
 
+    def _webhook_url(self, channel):
+        # Only check the configured labels, rather than every named channel on the host.
+        key = tuple((label, url, self.host[label] if label in self.host else None)
+                    for label, url in self.config["webhooks"].items())
+        if key != self._webhook_key:
+            log.debug("Rebuilding webhook index for %d labels", len(key))
+            self._webhook_key = key
+            self._webhook_urls = {host_channel: url for _, url, host_channel in key
+                                  if isinstance(host_channel, immp.Channel)}
+            urls = set(self._webhook_urls.values())
+            self._webhooks = {url: hook for url, hook in self._webhooks.items() if url in urls}
+        return self._webhook_urls.get(channel)
+
     def _resolve_channel(self, channel):
         dc_channel = self._get_channel(channel)
-        webhook = None
-        for label, host_channel in self.host.channels.items():
-            if channel == host_channel and label in self.config["webhooks"]:
-                webhook = discordpy.Webhook.from_url(self.config["webhooks"][label],
-                                                     session=self.session,
-                                                     bot_token=self.config["token"])
-                break
+        url = self._webhook_url(channel)
+        if not url:
+            return dc_channel, None
+        webhook = self._webhooks.get(url)
+        if not webhook:
+            webhook = discordpy.Webhook.from_url(url, session=self.session,
+                                                 bot_token=self.config["token"])
+            self._webhooks[url] = webhook
         return dc_channel, webhook
 
+    async def _fetch_file(self, attach, title, limit):
+        async with self._fetching:
+            async with (await attach.get_content(self.session)) as resp:
+                if resp.content_length and resp.content_length > limit:
+                    log.warning("Skipping file %r of %d bytes, over upload limit of %d bytes",
+                                title, resp.content_length, limit)
+                    return None
+                # discord.py expects a file-like object with a synchronous read() method.  Keep
+                # small files in memory, and move larger ones to disk as they're downloaded.
+                spool = SpooledTemporaryFile(self._spill_size)
+                size = 0
+                try:
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        size += len(chunk)
+                        if size > limit:
+                            log.warning("Skipping file %r, over upload limit of %d bytes",
+                                        title, limit)
+                            spool.close()
+                            return None
+                        spool.write(chunk)
+                except BaseException:
+                    spool.close()
+                    raise
+        spool.seek(0)
+        return discordpy.File(spool, title)
+
+    @staticmethod
+    def _close_file(file):
+        # discord.py only closes files that it opened itself, so close our spool separately.
+        file.close()
+        file.fp.close()
+
+    @classmethod
+    async def _discard_fetches(cls, fetches):
+        # Stop any downloads still running, and close any files already downloaded.
+        for fetch in fetches:
+            fetch.cancel()
+        for result in await gather(*fetches, return_exceptions=True):
+            if isinstance(result, discordpy.File):
+                cls._close_file(result)
+
     async def _requests(self, dc_channel, webhook, msg):
         name = image = None
         reply_to = reply_ref = reply_embed = None
         embeds = []
-        files = []
+        fetches = []
+        requests = []
         if msg.user:
             name = msg.user.real_name or msg.user.username
             image = msg.user.avatar
-        for i, attach in enumerate(msg.attachments or []):
-            if isinstance(attach, immp.File):
-                if attach.title:
-                    title = attach.title
-                elif attach.type == immp.File.Type.image:
-                    title = "image_{}.png".format(i)
-                elif attach.type == immp.File.Type.video:
-                    title = "video_{}.mp4".format(i)
-                else:
-                    title = "file_{}".format(i)
-                async with (await attach.get_content(self.session)) as img_content:
-                    # discord.py expects a file-like object with a synchronous read() method.
-                    # NB. The whole file is read into memory by discord.py anyway.
-                    files.append(discordpy.File(BytesIO(await img_content.read()), title))
-            elif isinstance(attach, immp.Location):
-                embed = discordpy.Embed()
-                embed.title = attach.name or "Location"
-                embed.url = attach.google_map_url
-                embed.description = attach.address
-                embed.set_thumbnail(url=attach.google_image_url(80))
-                embed.set_footer(text="{}, {}".format(attach.latitude, attach.longitude))
-                embeds.append((embed, "sent a location"))
-            elif isinstance(attach, immp.Message):
-                resolved = await self.resolve_message(attach)
-                embeds.append((await DiscordMessage.to_embed(self, resolved), "sent a message"))
         if msg.reply_to:
             if isinstance(msg.reply_to, immp.Receipt):
                 if msg.reply_to.channel.plug.network_id == self.network_id:
@@ -650,80 +678,129 @@ class DiscordPlug(immp.Plug, immp.HTTPOpenable):
             if not reply_to:
                 reply_to = msg.reply_to
             reply_embed = await DiscordMessage.to_embed(self, reply_to, True)
-        if webhook and msg.user:
-            # Sending via webhook: multiple embeds and files supported.
-            requests = []
-            rich = None
-            if reply_embed:
-                # Webhooks can't reply to other messages, quote the target in an embed instead.
-                # https://github.com/discord/discord-api-docs/issues/2251
-                embeds.append((reply_embed, None))
-            if msg.text:
-                rich = msg.text.clone()
-                if msg.action:
-                    for segment in rich:
-                        segment.italic = True
-            if msg.edited:
+        guild = getattr(dc_channel, "guild", None)
+        limit = guild.filesize_limit if guild else self._upload_limit
+        try:
+            for i, attach in enumerate(msg.attachments or []):
+                if isinstance(attach, immp.File):
+                    if attach.title:
+                        title = attach.title
+                    elif attach.type == immp.File.Type.image:
+                        title = "image_{}.png".format(i)
+                    elif attach.type == immp.File.Type.video:
+                        title = "video_{}.mp4".format(i)
+                    else:
+                        title = "file_{}".format(i)
+                    # Start downloading now, and collect the results once other attachments
+                    # are done.
+                    fetches.append(ensure_future(self._fetch_file(attach, title, limit)))
+                elif isinstance(attach, immp.Location):
+                    embed = discordpy.Embed()
+                    embed.title = attach.name or "Location"
+                    embed.url = attach.google_map_url
+                    embed.description = attach.address
+                    embed.set_thumbnail(url=attach.google_image_url(80))
+                    embed.set_footer(text="{}, {}".format(attach.latitude, attach.longitude))
+                    embeds.append((embed, "sent a location"))
+                elif isinstance(attach, immp.Message):
+                    resolved = await self.resolve_message(attach)
+                    embed = await DiscordMessage.to_embed(self, resolved)
+                    embeds.append((embed, "sent a message"))
+            files = [file for file in await gather(*fetches) if file]
+            if webhook and msg.user:
+                # Sending via webhook: multiple embeds and files supported.
+                rich = None
+                if reply_embed:
+                    # Webhooks can't reply to other messages, quote the target in an embed
+                    # instead.
+                    # https://github.com/discord/discord-api-docs/issues/2251
+                    embeds.append((reply_embed, None))
+                if msg.text:
+                    rich = msg.text.clone()
+                    if msg.action:
+                        for segment in rich:
+                            segment.italic = True
+                if msg.edited:
+                    if rich:
+                        rich.append(immp.Segment(" "))
+                    else:
+                        rich = immp.RichText()
+                    rich.append(immp.Segment("(edited)", italic=True))
+                text = None
                 if rich:
-                    rich.append(immp.Segment(" "))
-                else:
-                    rich = immp.RichText()
-                rich.append(immp.Segment("(edited)", italic=True))
-            text = None
-            if rich:
-                mark = DiscordRichText.to_markdown(self, rich)
-                chunks = immp.RichText.chunked_plain(mark, 2000)
-                if len(chunks) > 1:
-                    # Multiple messages required to accommodate the text.
-                    requests.extend(webhook.send(content=chunk, wait=True, username=name,
-                                                 avatar_url=image) for chunk in chunks)
-                else:
-                    text = chunks[0]
-            if text or embeds or files:
-                requests.append(webhook.send(content=text, wait=True, username=name,
-                                             avatar_url=image, files=files,
-                                             embeds=[embed[0] for embed in embeds]))
-            return requests
-        else:
-            # Sending via client: only a single embed per message.
-            requests = []
-            text = embed = desc = None
-            chunks = []
-            rich = msg.render(link_name=False, edit=msg.edited) or None
-            if rich:
-                mark = DiscordRichText.to_markdown(self, rich)
-                text, *chunks = immp.RichText.chunked_plain(mark, 2000)
-            if reply_embed and not reply_ref:
-                embeds.append((reply_embed, None))
-            if len(embeds) == 1:
-                # Attach the only embed to the message text.
-                embed, desc = embeds.pop()
-            if text or embed or files:
-                # Primary message: set reference for reply-to if applicable.
-                requests.append(dc_channel.send(content=text or desc, embed=embed, files=files,
-                                                reference=reply_ref))
-            # Send the remaining text if multiple messages were required to accommodate it.
-            requests.extend(dc_channel.send(content=chunk) for chunk in chunks)
-            for embed, desc in embeds:
-                # Send any additional embeds in their own separate messages.
-                content = None
-                if msg.user and desc:
-                    label = immp.Message(user=msg.user, text="sent {}".format(desc), action=True)
-                    content = DiscordRichText.to_markdown(self, label.render())
-                requests.append(dc_channel.send(content=content, embed=embed))
-            return requests
+                    mark = DiscordRichText.to_markdown(self, rich)
+                    chunks = immp.RichText.chunked_plain(mark, 2000)
+                    if len(chunks) > 1:
+                        # Multiple messages required to accommodate the text.
+                        requests.extend(webhook.send(content=chunk, wait=True, username=name,
+                                                     avatar_url=image) for chunk in chunks)
+                    else:
+                        text = chunks[0]
+                if text or embeds or files:
+                    requests.append(webhook.send(content=text, wait=True, username=name,
+                                                 avatar_url=image, files=files,
+                                                 embeds=[embed[0] for embed in embeds]))
+                return requests, files
+            else:
+                # Sending via client: only a single embed per message.
+                text = embed = desc = None
+                chunks = []
+                rich = msg.render(link_name=False, edit=msg.edited) or None
+                if rich:
+                    mark = DiscordRichText.to_markdown(self, rich)
+                    text, *chunks = immp.RichText.chunked_plain(mark, 2000)
+                if reply_embed and not reply_ref:
+                    embeds.append((reply_embed, None))
+                if len(embeds) == 1:
+                    # Attach the only embed to the message text.
+                    embed, desc = embeds.pop()
+                if text or embed or files:
+                    # Primary message: set reference for reply-to if applicable.
+                    requests.append(dc_channel.send(content=text or desc, embed=embed, files=files,
+                                                    reference=reply_ref))
+                # Send the remaining text if multiple messages were required to accommodate it.
+                requests.extend(dc_channel.send(content=chunk) for chunk in chunks)
+                for embed, desc in embeds:
+                    # Send any additional embeds in their own separate messages.
+                    content = None
+                    if msg.user and desc:
+                        label = immp.Message(user=msg.user, text="sent {}".format(desc),
+                                             action=True)
+                        content = DiscordRichText.to_markdown(self, label.render())
+                    requests.append(dc_channel.send(content=content, embed=embed))
+                return requests, files
+        except BaseException:
+            # Don't leave other downloads running, or their files open, if any part fails, and
+            # discard any requests already created.
+            for request in requests:
+                request.close()
+            await self._discard_fetches(fetches)
+            raise
 
     async def put(self, channel, msg):
         dc_channel, webhook = self._resolve_channel(channel)
-        requests = await self._requests(dc_channel, webhook, msg)
-        receipts = []
-        for request in requests:
-            message = await request
-            if not message.channel:
-                # Webhook-sent messages won't have their channel set.
-                message.channel = dc_channel
-            receipts.append(await DiscordMessage.from_message(self, message))
-        return receipts
+        requests, files = await self._requests(dc_channel, webhook, msg)
+        parses = []
+        try:
+            # Messages must be sent one at a time to keep their order, but each can be converted
+            # in the background whilst the next is being sent.
+            for request in requests:
+                message = await request
+                if not message.channel:
+                    # Webhook-sent messages won't have their channel set.
+                    message.channel = dc_channel
+                parses.append(ensure_future(DiscordMessage.from_message(self, message)))
+        except Exception:
+            for parse in parses:
+                parse.cancel()
+            raise
+        finally:
+            for request in requests:
+                # Discard any requests not yet made if an earlier one failed.
+                request.close()
+            for file in files:
+                self._close_file(file)
+        return list(await gather(*parses))
 
     async def delete(self, sent):
         dc_channel = self._resolve_channel(sent.channel)[0]
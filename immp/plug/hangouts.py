@@ -492,11 +492,17 @@ class HangoutsPlug(immp.Plug, immp.HTTPOpenable):
             self._looped.cancel()
             self._looped = None
         self._bot_user = None
+        self._fetch_user.clear()
 
     async def user_from_id(self, id_):
+        # Known users are kept up-to-date by the client, so only cache lookups of anyone else.
         user = self._users.get_user(hangups.user.UserID(chat_id=id_, gaia_id=id_))
         if user:
             return HangoutsUser.from_user(self, user)
+        return await self._fetch_user(id_)
+
+    @immp.cached(1000, 60 * 60)
+    async def _fetch_user(self, id_):
         request = hangouts_pb2.GetEntityByIdRequest(
             request_header=self._client.get_request_header(),
             batch_lookup_spec=[hangouts_pb2.EntityLookupSpec(gaia_id=id_)])
@@ -782,21 +788,30 @@ class HangoutsPlug(immp.Plug, immp.HTTPOpenable):
         conv = self._convs.get(channel.source)
         # Attempt to find sources for referenced messages.
         clone = copy(msg)
-        clone.reply_to = await self.resolve_message(clone.reply_to)
-        requests = []
-        for attach in clone.attachments:
-            # Generate requests for attached messages first.
-            if isinstance(attach, immp.Message):
-                requests += await self._requests(conv, await self.resolve_message(attach))
-        own_requests = await self._requests(conv, clone)
+        forwards = [attach for attach in clone.attachments if isinstance(attach, immp.Message)]
+        clone.reply_to, *forwards = await gather(self.resolve_message(clone.reply_to),
+                                                 *(self.resolve_message(attach)
+                                                   for attach in forwards))
+        # Prepare requests for attached messages and our own in parallel, including any uploads.
+        *forward_requests, own_requests = await gather(*(self._requests(conv, attach)
+                                                         for attach in forwards),
+                                                       self._requests(conv, clone))
+        requests = list(chain(*forward_requests))
         if requests and not own_requests:
             # Forwarding a message but no content to show who forwarded it.
             info = immp.Message(user=clone.user, action=True, text="forwarded a message")
             own_requests = await self._requests(conv, info)
         requests += own_requests
-        receipts = []
-        for request in requests:
-            response = await self._client.send_chat_message(request)
-            event = hangups.conversation.Conversation._wrap_event(response.created_event)
-            receipts.append(await HangoutsMessage.from_event(self, event))
-        return receipts
+        parses = []
+        try:
+            # Messages must be sent one at a time to keep their order, but each can be converted
+            # in the background whilst the next is being sent.
+            for request in requests:
+                response = await self._client.send_chat_message(request)
+                event = hangups.conversation.Conversation._wrap_event(response.created_event)
+                parses.append(ensure_future(HangoutsMessage.from_event(self, event)))
+        except Exception:
+            for parse in parses:
+                parse.cancel()
+            raise
+        return list(await gather(*parses))
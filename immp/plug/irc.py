@@ -33,25 +33,38 @@ Config:
         be made when sending a message with an unseen username, and reused for later messages.
     puppet-prefix (str):
         Leading characters to include in nicks of puppet users.
+    puppet-limit (int):
+        Maximum number of puppet connections to hold open at once (50 by default).  When a new
+        puppet is needed beyond this, the least recently used one disconnects.  Set to ``null`` for
+        no limit.
+    puppet-idle (float):
+        Time in seconds after which an unused puppet disconnects (1 hour by default), to be
+        reconnected the next time it's needed.  Set to ``null`` to keep puppets connected.
     send-delay (float):
-        Time in seconds to wait between sending each message (0.5 by default, i.e. 2 messages per
-        second), in order to avoid being kicked for flooding.
+        Time in seconds to wait between sending each message once the burst allowance is used up
+        (0.5 by default, i.e. 2 messages per second), in order to avoid being kicked for flooding.
 
         You can reduce this if the connecting IRC user has been given higher limits on the server,
         or increase this for servers with stricter flood limits.
+    send-burst (int):
+        Number of messages that can be sent at once before ``send-delay`` applies (4 by default).
+        The allowance recovers at the rate of one message per ``send-delay``.  Each connection,
+        including puppets, has its own allowance, and messages to different channels take turns.
 
 Channel sources should include the correct channel prefix or prefixes (typically just ``#``) for
 shared channels, and bare IRC nicks for private channels.
 """
 
-from asyncio import (CancelledError, ensure_future, Event, Future, Lock, open_connection, sleep,
-                     TimeoutError, wait_for)
+from asyncio import (CancelledError, ensure_future, Event, Future, gather, get_event_loop,
+                     Lock, open_connection, sleep, TimeoutError, wait_for)
 import codecs
+from collections import deque, OrderedDict
 from datetime import datetime, timedelta
 from hashlib import md5
 from itertools import chain
 import logging
 import re
+import time
 
 import immp
 
@@ -99,9 +112,7 @@ class Line:
             Any tags attached to the message.
     """
 
-    _format = re.compile("(?:@(?P<tags>[a-z0-9-]+(?:=[^; ]+)?(?:;[a-z0-9-]+(?:=[^; ]+)?)*) +)?"
-                         "(?::(?P<source>[^ ]+) +)?(?P<command>[a-z]+|[0-9]{3})"
-                         "(?P<args>(?: +[^: ][^ ]*)*)(?: +:(?P<trailing>.*))?", re.I)
+    __slots__ = ("command", "args", "source", "_tags", "_tagpart")
 
     def __init__(self, command, *args, source=None, tags=None):
         self.command = command.upper()
@@ -112,6 +123,24 @@ class Line:
     # Conveniently, this generates timestamp identifiers of the desired format.
     next_ts = immp.IDGen()
 
+    @property
+    def tags(self):
+        if self._tagpart is not None:
+            # Tags of received lines are only parsed when first accessed.
+            tags = {}
+            for item in self._tagpart.split(";"):
+                if item:
+                    key, *val = item.split("=", 1)
+                    tags[key] = val[0] if val else True
+            self._tags = tags
+            self._tagpart = None
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        self._tags = value
+        self._tagpart = None
+
     @classmethod
     def parse(cls, line):
         """
@@ -125,21 +154,31 @@ class Line:
             .Line:
                 Parsed line.
         """
-        match = cls._format.match(line)
-        if not match:
+        tagpart = source = None
+        rest = line
+        if rest.startswith("@"):
+            tagpart, _, rest = rest[1:].partition(" ")
+            rest = rest.lstrip(" ")
+        if rest.startswith(":"):
+            source, _, rest = rest[1:].partition(" ")
+            rest = rest.lstrip(" ")
+        # Middle arguments can't start with a colon, so the first one marks the trailing argument.
+        rest, _, trailing = rest.partition(" :")
+        args = rest.split()
+        command = args.pop(0) if args else ""
+        if not (source != "" and command.isascii() and
+                (command.isalpha() or (len(command) == 3 and command.isdigit()))):
             raise ValueError("Invalid line: '{}'".format(line))
-        tagpart, source, command, argpart, trailing = match.groups()
-        tags = {}
-        args = []
-        if tagpart:
-            for item in tagpart.split(";"):
-                key, *val = item.split("=", 1)
-                tags[key] = val[0] if val else True
-        if argpart:
-            args = argpart.split()
         if trailing:
             args.append(trailing)
-        return cls(command, *args, source=source, tags=tags)
+        # Skip the constructor, to avoid repacking the arguments.
+        parsed = cls.__new__(cls)
+        parsed.command = command.upper()
+        parsed.args = tuple(args)
+        parsed.source = source
+        parsed._tags = None
+        parsed._tagpart = tagpart or ""
+        return parsed
 
     def __str__(self):
         line = self.command
@@ -406,6 +445,8 @@ class Wait:
     Attributes:
         done (bool):
             ``True`` once a success or fail line has been received.
+        commands (str frozenset):
+            All commands that this wait will consume, used by clients to route lines.
     """
 
     def __init__(self, success, fail, collect):
@@ -414,6 +455,8 @@ class Wait:
         self._collect = tuple(collect)
         self._data = []
         self._result = Future()
+        self.commands = frozenset(chain(self._success, self._fail, self._collect,
+                                        (IRCTryAgain.COMMAND,)))
 
     @property
     def done(self):
@@ -501,13 +544,27 @@ class IRCClient:
         self.types = ""
         self.prefixes = ""
         self.prefix_map = {}
+        self._chanmodes = ("", "", "")
         self._nicklen = None
         self.network = None
-        # Track public channels, and joined channels' members.
+        # Track public channels, and joined channels' members and their privileges.
         self.users = {}
         self.members = {}
-        # Capture answers to pending queries.
-        self._waits = []
+        self.privileges = {}
+        # Capture answers to pending queries, indexed by the commands they consume.
+        self._waits = {}
+        # Coalesce outgoing lines into a single write per event loop iteration.
+        self._outbox = []
+        self._draining = Lock()
+        # Pace outgoing messages to stay within the server's flood limits.
+        self._flood = FloodControl(plug.config["send-burst"], plug.config["send-delay"])
+
+    @property
+    def send_queue(self):
+        """
+        Number of messages waiting to be sent by this client, keyed by target.
+        """
+        return self._flood.depth
 
     async def set_nick(self, value):
         """
@@ -558,6 +615,13 @@ class IRCClient:
     def oper_prefixes(self):
         return tuple(prefix for priv, prefix in self.prefix_map.items() if priv in ("o", "h"))
 
+    @property
+    def channels(self):
+        """
+        Names of channels this client is currently participating in.
+        """
+        return set(self.privileges)
+
     async def _regain_nick(self):
         if self._nick_target == self._nick:
             return
@@ -620,34 +684,69 @@ class IRCClient:
             ensure_future(self._reconnect("Disconnected"))
 
     def _write(self, *lines):
+        if not self._outbox:
+            get_event_loop().call_soon(self._flush)
         for line in lines:
             log.debug("Client %r sending line: %r", self._nick, line)
-            self._writer.write("{}\r\n".format(line).encode())
+            self._outbox.append("{}\r\n".format(line).encode())
+
+    def _flush(self):
+        if not self._outbox:
+            return
+        data = b"".join(self._outbox)
+        self._outbox.clear()
+        if self._writer:
+            self._writer.write(data)
+
+    async def _drain(self):
+        # Yield first so that lines written by other tasks this iteration go out in the same
+        # write, then wait for the transport buffer to empty.  Older stream writers only allow a
+        # single task to wait on a drain, so take turns.
+        await sleep(0)
+        self._flush()
+        if not self._writer:
+            return
+        async with self._draining:
+            if self._writer:
+                await self._writer.drain()
 
     async def _wait(self, *lines, success=(), fail=(), collect=()):
         wait = Wait(success, fail, collect)
         log.debug("Client %r adding wait: %r", self._nick, wait)
-        self._waits.append(wait)
-        self._write(*lines)
+        for command in wait.commands:
+            self._waits.setdefault(command, []).append(wait)
         try:
+            self._write(*lines)
+            await self._drain()
             result = await wait_for(wait, 10)
             log.debug("Client %r completing wait: %r", self._nick, wait)
         except TimeoutError:
             log.warning("Client %r timed out on wait: %r", self._nick, wait)
             raise
         finally:
-            self._waits.remove(wait)
+            self._remove_wait(wait)
         return result
 
+    def _remove_wait(self, wait):
+        for command in wait.commands:
+            waits = self._waits.get(command)
+            if not waits:
+                continue
+            try:
+                waits.remove(wait)
+            except ValueError:
+                pass
+            if not waits:
+                del self._waits[command]
+
     async def _handle(self, line):
         self._live.set()
-        # Route lines to any waits listening for them.
-        for wait in self._waits:
-            try:
+        # Route lines to the oldest wait listening for them.
+        for wait in self._waits.get(line.command, ()):
+            if not wait.done:
                 wait.add(line)
-            except (TypeError, ValueError):
-                continue
-            else:
+                if wait.done:
+                    self._remove_wait(wait)
                 break
         if line.command == "001":
             # Update our nick again in case it was truncated or otherwise changed.
@@ -668,6 +767,9 @@ class IRCClient:
                 elif key == "PREFIX":
                     privs, self.prefixes = value[1:].split(")", 1)
                     self.prefix_map = dict(zip(privs, self.prefixes))
+                elif key == "CHANMODES":
+                    # Only the first three types (list, always-param, set-param) take arguments.
+                    self._chanmodes = tuple(value.split(",")[:3])
                 elif key == "NICKLEN":
                     self._nicklen = int(value)
                 elif key == "NETWORK":
@@ -685,15 +787,30 @@ class IRCClient:
         elif line.command == "PING":
             self._write(Line("PONG", *line.args))
         elif line.command in ("JOIN", "PART", "KICK", "PRIVMSG"):
-            nick = line.source.split("!", 1)[0]
+            nick = line.args[1] if line.command == "KICK" else line.source.split("!", 1)[0]
             channel = line.args[0]
-            if channel in self.members:
+            if line.command == "JOIN" and nick == self._nick:
+                # Start tracking the channel, the full member list follows from join().
+                log.debug("Tracking members of %s", channel)
+                self.members[channel] = {nick}
+                self.privileges[channel] = {}
+            elif channel in self.privileges:
                 if line.command == "JOIN":
                     log.debug("Adding %s to %s member list", nick, channel)
                     self.members[channel].add(nick)
+                    if nick not in self.users:
+                        self.users[nick] = IRCUser.from_id(self._plug, line.source)
+                elif line.command in ("PART", "KICK") and nick == self._nick:
+                    log.debug("No longer tracking members of %s", channel)
+                    del self.members[channel]
+                    del self.privileges[channel]
                 elif line.command in ("PART", "KICK"):
                     log.debug("Removing %s from %s member list", nick, channel)
-                    self.members[channel].remove(nick)
+                    self.members[channel].discard(nick)
+                    self.privileges[channel].pop(nick, None)
+        elif line.command == "MODE":
+            if line.args[0] in self.privileges:
+                self._update_privileges(line.args[0], line.args[1], line.args[2:])
         elif line.command == "QUIT":
             nick = line.source.split("!", 1)[0]
             for name, members in list(self.members.items()):
@@ -703,6 +820,7 @@ class IRCClient:
                 elif nick in members:
                     log.debug("Converting QUIT to PART for %s in %s", nick, name)
                     await self._handle(Line("PART", name, source=line.source))
+            self.users.pop(nick, None)
             if self._nick_target == nick:
                 # Someone holding the nick we want just disconnected.
                 ensure_future(self._regain_nick())
@@ -726,6 +844,9 @@ class IRCClient:
                     log.debug("Replacing %s with %s in %s members", old, new, name)
                     members.remove(old)
                     members.add(new)
+                    privileges = self.privileges.get(name, {})
+                    if old in privileges:
+                        privileges[new] = privileges.pop(old)
             # Update our own nick if needed.
             if self._nick == old:
                 if len(new) < len(old) and old.startswith(new):
@@ -741,6 +862,31 @@ class IRCClient:
         if self._on_receive:
             await self._on_receive(line)
 
+    def _update_privileges(self, channel, modes, params):
+        # Apply channel mode changes to member prefixes, skipping over parameters for other modes.
+        privileges = self.privileges[channel]
+        params = iter(params)
+        adding = True
+        for mode in modes:
+            if mode in "+-":
+                adding = (mode == "+")
+            elif mode in self.prefix_map:
+                nick = next(params, None)
+                if not nick:
+                    break
+                prefix = self.prefix_map[mode]
+                current = privileges.get(nick, "").replace(prefix, "")
+                if adding:
+                    current += prefix
+                if current:
+                    privileges[nick] = current
+                else:
+                    privileges.pop(nick, None)
+            elif mode in self._chanmodes[0] or mode in self._chanmodes[1]:
+                next(params, None)
+            elif adding and mode in self._chanmodes[2]:
+                next(params, None)
+
     async def connect(self):
         """
         Join the target IRC server.
@@ -784,14 +930,17 @@ class IRCClient:
                 Disconnect message sent to the server.
         """
         self._closing = True
-        for wait in self._waits:
-            wait.cancel()
+        for wait in set(chain.from_iterable(self._waits.values())):
+            if not wait.done:
+                wait.cancel()
         self._waits.clear()
+        self._flood.cancel()
         if self._live_task:
             self._live_task.cancel()
             self._live_task = None
         if self._writer:
             self._write(Line("QUIT", msg))
+            self._flush()
             if self._read_task:
                 try:
                     await wait_for(self._read_task, 10)
@@ -804,8 +953,10 @@ class IRCClient:
             self._writer.close()
             self._writer = None
         self._reader = None
+        self._outbox.clear()
         self.users.clear()
         self.members.clear()
+        self.privileges.clear()
 
     async def _reconnect(self, msg):
         await self.disconnect(msg)
@@ -836,21 +987,31 @@ class IRCClient:
                 Matching users, either a single user or all participants of a channel.
         """
         if name in self.members:
-            return self.members[name]
+            return {self.users[nick] for nick in self.members[name] if nick in self.users}
         elif name in self.users:
             self.members[name] = {name}
             return {self.users[name]}
+        return await self._who(name)
+
+    async def _who(self, name):
         members = set()
         users = set()
+        privileges = {}
         for line in await self._wait(Line("WHO", name), success=("315",), collect=("352",)):
             user = IRCUser.from_who(self._plug, line)
             members.add(user.username)
             users.add(user)
             self.members[user.username] = {user.username}
             self.users[user.username] = user
-        if members:
-            self.members[name] = members
-        elif name in self.members:
+            # Flags are the away status, an optional IRCop marker, and any channel prefixes.
+            prefix = "".join(char for char in line.args[6] if char in self.prefixes)
+            if prefix:
+                privileges[user.username] = prefix
+        if name in self.privileges:
+            # Only joined channels are kept up-to-date, don't hold onto other channels' members.
+            self.members[name] = members | {self._nick}
+            self.privileges[name] = privileges
+        elif not members and name in self.members:
             del self.members[name]
         return users
 
@@ -888,7 +1049,8 @@ class IRCClient:
             return
         await self._regain_nick()
         await self._wait(Line("JOIN", channel), success=("JOIN",))
-        await self.who(channel)
+        # Sync the member list once, which is then maintained from incoming events.
+        await self._who(channel)
 
     async def part(self, channel):
         """
@@ -979,8 +1141,10 @@ class IRCClient:
                 Resulting line sent to the server.
         """
         await self._regain_nick()
+        await self._flood.acquire(channel)
         line = Line("PRIVMSG", channel, text)
         self._write(line)
+        await self._drain()
         line.source = self.nickmask
         return line
 
@@ -988,25 +1152,90 @@ class IRCClient:
         return "<{}: {!r}>".format(self.__class__.__name__, self.nickmask or self.nick)
 
 
-class DelayLock:
+class FloodControl:
     """
-    Timed-release lock, used in an ``async with`` statement to acquire a lock, but delay its
-    release by some number of seconds after the caller has finished with it.
+    Outgoing message scheduler, modelled on typical server flood rules: a burst of messages may be
+    sent at once, after which the allowance refills at a fixed rate.  Messages to each target are
+    queued separately and take turns, so that a busy channel doesn't hold up all the others.
+
+    Attributes:
+        bucket (.TokenBucket):
+            Underlying allowance of messages, or ``None`` if sending without delays.
     """
 
-    def __init__(self, delay):
-        self._delay = delay
-        self._lock = Lock()
+    def __init__(self, burst, delay):
+        self.bucket = immp.TokenBucket(max(burst, 1), 1 / delay) if delay > 0 else None
+        # Mapping from targets to queues of waiting senders, and the order to serve them in.
+        self._queues = {}
+        self._targets = deque()
+        self._task = None
 
-    async def _delay_release(self):
-        await sleep(self._delay())
-        self._lock.release()
+    @property
+    def depth(self):
+        """
+        Number of messages currently waiting to be sent, keyed by target.
+        """
+        return {target: sum(1 for waiter in queue if not waiter.done())
+                for target, queue in self._queues.items()}
+
+    def _next(self):
+        # Take the first live waiter for the next target in turn, requeueing the target if it has
+        # any more waiters.
+        while self._targets:
+            target = self._targets.popleft()
+            queue = self._queues[target]
+            waiter = None
+            while queue and not waiter:
+                waiter = queue.popleft()
+                if waiter.done():
+                    # Sender was cancelled whilst waiting.
+                    waiter = None
+            if queue:
+                self._targets.append(target)
+            else:
+                del self._queues[target]
+            if waiter:
+                return waiter
+        return None
+
+    async def _dispatch(self):
+        while self._targets:
+            await self.bucket.acquire()
+            waiter = self._next()
+            if waiter:
+                waiter.set_result(None)
+
+    async def acquire(self, target):
+        """
+        Wait for a turn to send a message to the given target.
 
-    async def __aenter__(self):
-        await self._lock.acquire()
+        Args:
+            target (str):
+                Channel name or user nick being sent to.
+        """
+        if not self.bucket:
+            return
+        waiter = Future()
+        if target not in self._queues:
+            self._queues[target] = deque()
+            self._targets.append(target)
+        self._queues[target].append(waiter)
+        if not self._task or self._task.done():
+            self._task = ensure_future(self._dispatch())
+        await waiter
 
-    async def __aexit__(self, exc_type, exc_value, traceback):
-        ensure_future(self._delay_release())
+    def cancel(self):
+        """
+        Stop dispatching, and cancel any waiting senders.
+        """
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for queue in self._queues.values():
+            for waiter in queue:
+                waiter.cancel()
+        self._queues.clear()
+        self._targets.clear()
 
 
 class IRCPlug(immp.Plug):
@@ -1014,6 +1243,10 @@ class IRCPlug(immp.Plug):
     Plug for an IRC server.
     """
 
+    # Number of puppets that can connect at once, and the time in seconds between further ones.
+    _puppet_burst = 3
+    _puppet_delay = 5.0
+
     schema = immp.Schema({"server": {"host": str,
                                      "port": int,
                                      immp.Optional("ssl", False): bool,
@@ -1027,17 +1260,27 @@ class IRCPlug(immp.Plug):
                           immp.Optional("quote-reply-to", True): bool,
                           immp.Optional("puppet", False): bool,
                           immp.Optional("puppet-prefix", ""): str,
-                          immp.Optional("send-delay", 0.5): float})
+                          immp.Optional("puppet-limit", 50): immp.Nullable(int),
+                          immp.Optional("puppet-idle", 3600.0): immp.Nullable(float),
+                          immp.Optional("send-delay", 0.5): float,
+                          immp.Optional("send-burst", 4): int})
 
     def __init__(self, name, config, host):
         super().__init__(name, config, host)
         self._client = None
         # Don't yield messages for initial self-joins.
         self._joins = set()
-        # Maintain puppet clients by nick for cleaner sending.
-        self._puppets = {}
-        # Queue multiple outgoing messages in quick succession and insert delays between them.
-        self._delay_lock = DelayLock(lambda: self.config["send-delay"])
+        # Maintain puppet clients by nick for cleaner sending, ordered from least recently used.
+        self._puppets = OrderedDict()
+        # Time each puppet was last used, for disconnecting idle ones.
+        self._puppet_used = {}
+        self._puppet_reaper = None
+        # Number of sends or connects in progress for each puppet, which shouldn't be disconnected.
+        self._puppet_busy = {}
+        # Disconnects of dropped puppets still in progress.
+        self._puppet_drops = set()
+        # Stagger new puppet connections, to stay under server connection throttling.
+        self._puppet_connects = immp.TokenBucket(self._puppet_burst, 1 / self._puppet_delay)
         # Cache the last message in each channel, to suppress reply quoting when directly below.
         self._last_msgs = {}
 
@@ -1053,6 +1296,15 @@ class IRCPlug(immp.Plug):
     def network_id(self):
         return "irc:{}".format(self.config["server"]["host"])
 
+    @property
+    def send_queue(self):
+        """
+        Number of messages waiting to be sent by each client (the main user and any puppets),
+        keyed by nick and then target.
+        """
+        clients = [self._client, *self._puppets.values()] if self._client else []
+        return {client.nick: client.send_queue for client in clients if client.send_queue}
+
     async def start(self):
         await super().start()
         self._client = IRCClient(self,
@@ -1066,15 +1318,56 @@ class IRCPlug(immp.Plug):
                                  self._connected,
                                  self._handle)
         await self._client.connect()
+        if self.config["puppet"] and self.config["puppet-idle"]:
+            self._puppet_reaper = ensure_future(self._reap_puppets())
 
     async def stop(self):
         await super().stop()
+        if self._puppet_reaper:
+            self._puppet_reaper.cancel()
+            self._puppet_reaper = None
         if self._client:
             await self._client.disconnect(self.config["quit"])
             self._client = None
         for client in self._puppets.values():
             await client.disconnect(self.config["quit"])
         self._puppets.clear()
+        self._puppet_used.clear()
+        self._puppet_busy.clear()
+        if self._puppet_drops:
+            await gather(*self._puppet_drops, return_exceptions=True)
+
+    def _puppet_idle(self, puppet):
+        # Puppets connecting, sending or with messages queued are in use, and shouldn't be dropped.
+        return not self._puppet_busy.get(puppet) and not puppet.send_queue
+
+    def _drop_puppet(self, user, reason):
+        puppet = self._puppets.pop(user)
+        del self._puppet_used[user]
+        log.debug("Disconnecting %s puppet %r for user %r", reason, puppet, user)
+        task = ensure_future(puppet.disconnect(self.config["quit"]))
+        self._puppet_drops.add(task)
+        task.add_done_callback(self._puppet_dropped)
+
+    def _puppet_dropped(self, task):
+        self._puppet_drops.discard(task)
+        if not task.cancelled() and task.exception():
+            log.warning("Failed to disconnect puppet", exc_info=task.exception())
+
+    async def _reap_puppets(self):
+        while True:
+            idle = self.config["puppet-idle"]
+            await sleep(min(idle or 60, 60))
+            if not idle:
+                continue
+            cutoff = time.monotonic() - idle
+            for user, used in list(self._puppet_used.items()):
+                if used < cutoff and self._puppet_idle(self._puppets[user]):
+                    self._drop_puppet(user, "idle")
+
+    def _use_puppet(self, user):
+        self._puppets.move_to_end(user)
+        self._puppet_used[user] = time.monotonic()
 
     def get_user(self, nick):
         return self._client.users.get(nick)
@@ -1112,13 +1405,9 @@ class IRCPlug(immp.Plug):
         return [immp.Channel(self, channel) for channel in channels]
 
     async def private_channels(self):
-        try:
-            raw = await self._client.all_names()
-        except IRCTryAgain:
-            return None
         names = set(self._client.users)
-        for line in raw:
-            names.update(name.lstrip(self._client.prefixes) for name in line.args[3].split())
+        for channel in self._client.channels:
+            names.update(self._client.members[channel])
         names.discard(self._client.nick)
         for client in self._puppets.values():
             names.discard(client.nick)
@@ -1151,6 +1440,15 @@ class IRCPlug(immp.Plug):
             return None
         if await channel.is_private():
             return None
+        opers = self._client.oper_prefixes
+        try:
+            privileges = self._client.privileges[channel.source]
+        except KeyError:
+            pass
+        else:
+            ops = [nick for nick, prefix in privileges.items()
+                   if any(char in opers for char in prefix)]
+            return [await self.user_from_username(nick) for nick in ops]
         try:
             raw = await self._client.names(channel.source)
         except IRCTryAgain:
@@ -1159,7 +1457,7 @@ class IRCPlug(immp.Plug):
         for line in raw:
             nicks = line.args[-1].split()
             ops.extend(nick.lstrip(self._client.prefixes) for nick in nicks
-                       if nick.startswith(self._client.oper_prefixes))
+                       if nick.startswith(opers))
         return [await self.user_from_username(nick) for nick in ops]
 
     async def channel_invite(self, channel, user):
@@ -1258,13 +1556,20 @@ class IRCPlug(immp.Plug):
                 return None
         else:
             log.debug("Reusing puppet %r for user %r", puppet, user)
+            self._use_puppet(user)
             if puppet.nick.rstrip("_") != nick:
-                await puppet.set_nick(nick)
+                # Keep it from being dropped whilst renaming.
+                self._puppet_hold(puppet)
+                try:
+                    await puppet.set_nick(nick)
+                finally:
+                    self._puppet_release(puppet)
             return puppet
         if user.plug and user.plug.network_id == self.network_id:
-            for puppet in self._puppets.values():
+            for puppet_user, puppet in self._puppets.items():
                 if user.id == puppet.nickmask:
                     log.debug("Matched nickmask with puppet %r", user.id)
+                    self._use_puppet(puppet_user)
                     return puppet
         log.debug("Adding puppet %r for user %r", nick, user)
         real_name = user.real_name or user.username
@@ -1280,9 +1585,33 @@ class IRCPlug(immp.Plug):
                            "immp",
                            real_name)
         self._puppets[user] = puppet
-        await puppet.connect()
+        self._puppet_used[user] = time.monotonic()
+        limit = self.config["puppet-limit"]
+        if limit and len(self._puppets) > limit:
+            # Oldest first, skipping over any puppets still in use.
+            for old in list(self._puppets):
+                if len(self._puppets) <= limit:
+                    break
+                elif old is not user and self._puppet_idle(self._puppets[old]):
+                    self._drop_puppet(old, "least recently used")
+        self._puppet_hold(puppet)
+        try:
+            async with self._puppet_connects:
+                await puppet.connect()
+        finally:
+            self._puppet_release(puppet)
         return puppet
 
+    def _puppet_hold(self, puppet):
+        self._puppet_busy[puppet] = self._puppet_busy.get(puppet, 0) + 1
+
+    def _puppet_release(self, puppet):
+        count = self._puppet_busy.get(puppet, 0) - 1
+        if count > 0:
+            self._puppet_busy[puppet] = count
+        else:
+            self._puppet_busy.pop(puppet, None)
+
     async def put(self, channel, msg):
         user = None if self.config["puppet"] else msg.user
         lines = []
@@ -1313,16 +1642,20 @@ class IRCPlug(immp.Plug):
         receipts = []
         if self.config["puppet"] and msg.user:
             client = await self._puppet(msg.user)
-            if not await channel.is_private():
-                await client.join(channel.source)
+            self._puppet_hold(client)
         else:
             client = self._client
-        for text in lines:
-            async with self._delay_lock:
+        try:
+            if client is not self._client and not await channel.is_private():
+                await client.join(channel.source)
+            for text in lines:
                 line = await client.send(channel.source, text)
-            sent = await IRCMessage.from_line(self, line)
-            self.queue(sent)
-            receipts.append(sent)
+                sent = await IRCMessage.from_line(self, line)
+                self.queue(sent)
+                receipts.append(sent)
+        finally:
+            if client is not self._client:
+                self._puppet_release(client)
         self._last_msgs[channel] = receipts
         if self.config["puppet"]:
             for member in msg.joined:
@@ -19,6 +19,9 @@ Config:
         ``True`` to always send outgoing thread replies back to the channel.
     real-names (bool):
         ``True`` to prefer user real names when sending messages, ``False`` to prefer usernames.
+    cache (str):
+        Optional path to store a JSON file of the workspace's users and channels, so that they don't
+        all need to be fetched again after a restart.
 
 Slack supports multiple types of apps and legacy integrations; this plug supports most of them.  If
 you're starting fresh, you should `create a new Slack App <https://api.slack.com/apps>`_ and follow
@@ -70,13 +73,12 @@ like ``#channel`` is not supported (it may work for sending, but each message re
 attributed to its identifier rather than name).
 """
 
-from asyncio import CancelledError, ensure_future, gather, Lock, sleep
+from asyncio import CancelledError, ensure_future, gather, get_event_loop, Lock, shield, sleep
 from copy import copy
-from collections import defaultdict
 from datetime import datetime, timezone
-from functools import partial
-from json import dumps as json_dumps
+from json import dump as json_dump, dumps as json_dumps, load as json_load
 import logging
+import os
 import re
 import time
 
@@ -100,7 +102,8 @@ class _Schema:
                           immp.Optional("app-token"): immp.Nullable(str),
                           immp.Optional("fallback-image"): immp.Nullable(str),
                           immp.Optional("thread-broadcast", False): bool,
-                          immp.Optional("real-names", True): bool})
+                          immp.Optional("real-names", True): bool,
+                          immp.Optional("cache"): immp.Nullable(str)})
 
     user = immp.Schema({"id": str,
                         "name": str,
@@ -223,6 +226,83 @@ class SlackAPIError(immp.PlugError):
     """
 
 
+class SlackAPIRateLimitError(SlackAPIError):
+    """
+    Request rejected by the Slack API due to rate limiting.
+
+    Attributes:
+        retry_after (int):
+            Number of seconds to wait before trying again.
+    """
+
+    def __init__(self, *args, retry_after=None):
+        super().__init__(*args)
+        self.retry_after = retry_after
+
+
+class _RateLimiter:
+    # Slack applies limits per API method and workspace, grouped into tiers of around 1, 20, 50 and
+    # 100 requests per minute, with some tolerance for short bursts.  Posting messages is instead
+    # limited to around one per second in each channel.
+
+    tiers = {1: (1, 1 / 60),
+             2: (20, 20 / 60),
+             3: (50, 50 / 60),
+             4: (100, 100 / 60)}
+
+    methods = {"apps.connections.open": 1,
+               "rtm.connect": 1,
+               "conversations.list": 2,
+               "files.upload": 2,
+               "users.list": 2,
+               "bots.info": 3,
+               "chat.delete": 3,
+               "conversations.history": 3,
+               "conversations.invite": 3,
+               "conversations.join": 3,
+               "conversations.kick": 3,
+               "conversations.leave": 3,
+               "conversations.open": 3,
+               "conversations.replies": 3,
+               "team.info": 3,
+               "auth.test": 4,
+               "conversations.members": 4,
+               "users.info": 4}
+
+    default_tier = 3
+
+    def __init__(self):
+        self.buckets = {}
+
+    def _bucket(self, key):
+        try:
+            return self.buckets[key]
+        except KeyError:
+            if ":" in key:
+                bucket = immp.TokenBucket(3, 1)
+            else:
+                bucket = immp.TokenBucket(*self.tiers[self.methods.get(key, self.default_tier)])
+            self.buckets[key] = bucket
+            return bucket
+
+    @staticmethod
+    def _key(endpoint, channel=None):
+        return "{}:{}".format(endpoint, channel) if channel else endpoint
+
+    async def wait(self, endpoint, channel=None):
+        await self._bucket(self._key(endpoint, channel)).acquire()
+        # Drop idle buckets once they've fully refilled, as they're equivalent to new ones.
+        for key in [key for key, bucket in self.buckets.items() if bucket.full]:
+            del self.buckets[key]
+
+    def pause(self, endpoint, channel, delay):
+        self._bucket(self._key(endpoint, channel)).pause(delay)
+
+    @property
+    def depth(self):
+        return {key: bucket.waiting for key, bucket in self.buckets.items() if bucket.waiting}
+
+
 class MessageNotFound(Exception):
     # No match for a given channel and ts pair.
     pass
@@ -237,10 +317,11 @@ class SlackUser(immp.User):
             Reference to the Slack integration app for a bot user.
     """
 
-    def __init__(self, id_=None, plug=None, display_name=None, real_name=None, avatar=None,
-                 bot_id=None, app=False, raw=None):
+    def __init__(self, id_=None, plug=None, username=None, display_name=None, real_name=None,
+                 avatar=None, bot_id=None, app=False, raw=None):
         super().__init__(id_=id_,
                          plug=plug,
+                         username=username,
                          avatar=avatar,
                          raw=raw)
         self._display_name = display_name
@@ -296,6 +377,7 @@ class SlackUser(immp.User):
         member = _Schema.user(json)
         return cls(id_=member["id"],
                    plug=slack,
+                   username=member["name"],
                    display_name=member["profile"]["display_name"],
                    real_name=member["profile"]["real_name"],
                    avatar=cls._best_image(member["profile"]),
@@ -336,31 +418,14 @@ class SlackRichText(immp.RichText):
     # "*_<http://example.com|B+I+L>_* _just I_" and the first segment's italic breaks.  For some
     # reason this doesn't happen with bold and italic swapped here and in the text.
     tags = {"_": "italic", "*": "bold", "~": "strike", "`": "code", "```": "pre"}
-    # A rather complicated expression to match formatting tags according to the following rules:
-    # 1) Outside of formatting may not be adjacent to alphanumeric or other formatting characters.
-    # 2) Inside of formatting may not be adjacent to whitespace or the current formatting character.
-    # 3) Formatting characters may be escaped with a backslash.
-    # This still isn't perfect, but provides a good approximation outside of edge cases.
     # Slack only has limited documentation: https://get.slack.help/hc/en-us/articles/202288908
-    _outside_chars = r"0-9a-z*_~"
-    _tag_chars = r"[*_~`]"
-    _inside_chars = r"\s\1"
-    _format_regex = re.compile(r"(?<![{0}\\])({1})(?![{2}])(.+?)(?<![{2}\\])\1(?![{0}])"
-                               .format(_outside_chars, _tag_chars, _inside_chars))
-    _pre_regex = re.compile(r"```\n?(.+?)\n?```", re.DOTALL)
-
-    _link_regex = re.compile(r"<([^@#\|][^\|>]*?)(?:\|([^>]+?))?>")
-    _mention_regex = re.compile(r"<@([^\|>]+?)(?:\|[^>]+?)?>")
-    _channel_regex = re.compile(r"<#([^\|>]+?)(?:\|[^>]+?)?>")
-
-    @classmethod
-    def _sub_channel(cls, slack, match):
-        return "#{}".format(slack._channels[match.group(1)]["name"])
-
-    @classmethod
-    def _sub_link(cls, match):
-        # Use a label if we have one, else just show the URL.
-        return match.group(2) or match.group(1)
+    # Doubled tags (e.g. "**bold**") are accepted like single ones, as the old parser did.  Tags
+    # that overlap rather than nest (e.g. "*a _b* c_") keep only the outer format, formatting
+    # isn't applied inside code, and formatting characters inside links are left alone.
+    # Entities are links, user mentions and channels, each with an optional label.
+    _markup = immp.InlineMarkup({tag: attr for tag, attr in tags.items() if attr != "pre"},
+                                entities=r"<([@#]?)([^\|>]+)(?:\|([^>]*))?>",
+                                pre=r"```\n?(.+?)\n?```")
 
     @classmethod
     def _escape(cls, text):
@@ -370,6 +435,13 @@ class SlackRichText(immp.RichText):
     def _unescape(cls, text):
         return text.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
 
+    @classmethod
+    def _segment(cls, text, formatting, **kwargs):
+        text = cls._unescape(text)
+        if not (formatting.get("code") or formatting.get("pre")):
+            text = emojize(text, language="alias")
+        return immp.Segment(text, **formatting, **kwargs)
+
     @classmethod
     async def from_mrkdwn(cls, slack, text):
         """
@@ -385,69 +457,34 @@ class SlackRichText(immp.RichText):
             .SlackRichText:
                 Parsed rich text container.
         """
-        changes = defaultdict(dict)
-        plain = ""
-        done = False
-        while not done:
-            # Identify pre blocks, parse formatting only outside of them.
-            match = cls._pre_regex.search(text)
-            if match:
-                parse = text[:match.start()]
-                pre = match.group(1)
-                text = text[match.end():]
-            else:
-                parse = text
-                done = True
-            offset = len(plain)
-            while True:
-                match = cls._format_regex.search(parse)
-                if not match:
-                    break
-                start = match.start()
-                end = match.end()
-                tag = match.group(1)
-                # Strip the tag characters from the message.
-                parse = parse[:start] + match.group(2) + parse[end:]
-                end -= 2 * len(tag)
-                # Record the range where the format is applied.
-                field = cls.tags[tag]
-                changes[offset + start][field] = True
-                changes[offset + end][field] = False
-                # Shift any future tags back.
-                for pos in sorted(changes):
-                    if pos > offset + end:
-                        changes[pos - 2 * len(tag)].update(changes.pop(pos))
-            plain += parse
-            if not done:
-                changes[len(plain)]["pre"] = True
-                changes[len(plain + pre)]["pre"] = False
-                plain += pre
-        for match in cls._link_regex.finditer(plain):
-            # Store the link target; the link tag will be removed after segmenting.
-            changes[match.start()]["link"] = cls._unescape(match.group(1))
-            changes[match.end()]["link"] = None
-        for match in cls._mention_regex.finditer(plain):
-            changes[match.start()]["mention"] = await slack.user_from_id(match.group(1))
-            changes[match.end()]["mention"] = None
+        runs = cls._markup.parse(text)
+        # Resolve all mentioned users up front, rather than one at a time.
+        ids = list({match.group(2) for _, _, match in runs if match and match.group(1) == "@"})
+        users = dict(zip(ids, await gather(*(slack.user_from_id(id_) for id_ in ids))))
         segments = []
-        points = list(sorted(changes.keys()))
-        formatting = {}
-        # Iterate through text in change start/end pairs.
-        for start, end in zip([0] + points, points + [len(plain)]):
-            formatting.update(changes[start])
-            if start == end:
-                # Zero-length segment at the start or end, ignore it.
+        for part, formatting, match in runs:
+            if not match:
+                segments.append(cls._segment(part, formatting))
                 continue
-            if formatting.get("mention"):
-                user = formatting["mention"]
-                part = "@{}".format(user.real_name)
+            kind, target, label = match.groups()
+            if kind == "@":
+                user = users.get(target)
+                if user:
+                    segments.append(immp.Segment("@{}".format(user.real_name), mention=user,
+                                                 **formatting))
+                else:
+                    segments.append(cls._segment(part, formatting))
+            elif kind == "#":
+                try:
+                    name = slack._channels[target]["name"]
+                except KeyError:
+                    # Channel not cached yet, or not visible to us.
+                    name = label or target
+                segments.append(cls._segment("#{}".format(name), formatting))
             else:
-                part = plain[start:end]
-                # Strip Slack channel tags, replace with a plain-text representation.
-                part = cls._channel_regex.sub(partial(cls._sub_channel, slack), part)
-                part = cls._link_regex.sub(cls._sub_link, part)
-                part = emojize(cls._unescape(part), language="alias")
-            segments.append(immp.Segment(part, **formatting))
+                # Use a label if we have one, else just show the URL.
+                segments.append(cls._segment(label or target, formatting,
+                                             link=cls._unescape(target)))
         return cls(segments)
 
     @classmethod
@@ -830,6 +867,15 @@ class SlackPlug(immp.Plug, immp.HTTPOpenable):
 
     schema = _Schema.config
 
+    # Format of the workspace cache file, increment to discard existing files if changed.
+    _cache_version = 1
+    # Age in seconds after which to refresh all cached users and channels.
+    _cache_refresh = 24 * 60 * 60
+    # Age in seconds after which to refetch channel members, in case of missed events.
+    _members_ttl = 60 * 60
+    # Number of times to retry a rate limited request before giving up.
+    _rate_limit_retries = 3
+
     @property
     def network_name(self):
         return "{} Slack".format(self._team["name"]) if self._team else "Slack"
@@ -841,12 +887,38 @@ class SlackPlug(immp.Plug, immp.HTTPOpenable):
     def __init__(self, name, config, host):
         super().__init__(name, config, host)
         self._team = self._bot_user = None
-        self._users = self._channels = self._directs = None
-        self._bot_to_app = self._bot_to_user = self._members = None
+        # Workspace caches, kept across reconnects and updated from events.
+        self._users = {}
+        self._channels = {}
+        self._directs = {}
+        # Secondary indexes: mapping from usernames to user IDs, and user IDs to IM channel IDs.
+        self._usernames = {}
+        self._user_directs = {}
+        self._bot_to_app = {}
+        self._bot_to_user = {}
+        self._members = immp.LRUCache(ttl=self._members_ttl)
+        # Workspace and bot user that the caches belong to.
+        self._cache_key = None
+        # Background write of the cache file, if one is in progress.
+        self._cache_write = None
+        # Time of the last full refresh of users and channels, and the refresh task if running.
+        # A refresh is also due after a (re)start, to catch anything missed whilst offline.
+        self._synced = None
+        self._syncing = None
+        self._refresh = True
         # Connection objects that need to be closed on disconnect.
         self._socket = self._receive = None
         self._app_socket = False
         self._closing = False
+        self._limiter = _RateLimiter()
+
+    @property
+    def send_queue(self):
+        """
+        Number of API requests currently held back by rate limiting, keyed by API method (and
+        channel ID, for posted messages).
+        """
+        return self._limiter.depth
 
     def same_team(self, other):
         """
@@ -862,13 +934,36 @@ class SlackPlug(immp.Plug, immp.HTTPOpenable):
         """
         return isinstance(other, self.__class__) and self._team["id"] == other._team["id"]
 
-    async def _api(self, endpoint, schema=_Schema.api, app=False, *, headers=None, **kwargs):
-        headers = headers or {}
+    async def _api(self, endpoint, schema=_Schema.api, app=False, **kwargs):
+        # Requests are paced to stay within Slack's rate limits, and retried a few times if limited,
+        # though form data can only be sent once, so the caller must rebuild and retry those.
+        channel = None
+        if endpoint == "chat.postMessage" and isinstance(kwargs.get("data"), dict):
+            channel = kwargs["data"].get("channel")
+        for attempt in range(self._rate_limit_retries + 1):
+            await self._limiter.wait(endpoint, channel)
+            try:
+                return await self._api_request(endpoint, schema, app, **kwargs)
+            except SlackAPIRateLimitError as e:
+                log.debug("Rate limited on %r for %d seconds", endpoint, e.retry_after)
+                self._limiter.pause(endpoint, channel, e.retry_after)
+                if isinstance(kwargs.get("data"), FormData) or attempt == self._rate_limit_retries:
+                    raise
+
+    async def _api_request(self, endpoint, schema=_Schema.api, app=False, *, headers=None,
+                           **kwargs):
+        headers = dict(headers or {})
         token = app and self.config["app-token"] or self.config["token"]
         headers["Authorization"] = "Bearer {}".format(token)
         log.debug("User %r making API request to %r", self._bot_user, endpoint)
         async with self.session.post("https://slack.com/api/{}".format(endpoint),
                                      headers=headers, **kwargs) as resp:
+            if resp.status == 429:
+                try:
+                    retry_after = int(resp.headers["Retry-After"])
+                except (KeyError, ValueError):
+                    retry_after = 1
+                raise SlackAPIRateLimitError("Rate limited", retry_after=retry_after)
             try:
                 resp.raise_for_status()
             except ClientResponseError as e:
@@ -892,25 +987,156 @@ class SlackPlug(immp.Plug, immp.HTTPOpenable):
                 break
         return items
 
-    async def _rtm(self):
-        auth = await self._api("auth.test", _Schema.auth_test)
-        self._bot_user = auth["user_id"]
+    def _reset_cache(self):
+        self._users.clear()
+        self._channels.clear()
+        self._directs.clear()
+        self._usernames.clear()
+        self._user_directs.clear()
+        self._bot_to_app.clear()
+        self._bot_to_user.clear()
+        self._members.clear()
+        self._synced = None
+
+    async def _load_cache(self):
+        if not self.config["cache"] or self._synced:
+            return
+        try:
+            cache = await get_event_loop().run_in_executor(None, self._read_cache)
+        except FileNotFoundError:
+            log.debug("No existing cache file at %r", self.config["cache"])
+            return
+        except (OSError, ValueError):
+            log.warning("Failed to read cache file %r", self.config["cache"], exc_info=True)
+            return
+        if (cache.get("version") != self._cache_version or
+                cache.get("team") != self._team["id"] or cache.get("bot") != self._bot_user):
+            log.debug("Discarding cache file for a different version or workspace")
+            return
+        self._users = {u["id"]: SlackUser.from_member(self, u) for u in cache["users"]}
+        self._channels = {c["id"]: c for c in cache["channels"]}
+        self._directs = {c["id"]: c for c in cache["directs"]}
+        self._reindex()
+        self._synced = cache["synced"]
+        log.debug("User %r loaded %d users, %d channels, %d IMs from cache", self._bot_user,
+                  len(self._users), len(self._channels), len(self._directs))
+
+    def _read_cache(self):
+        with open(self.config["cache"]) as file_:
+            return json_load(file_)
+
+    def _save_cache(self):
+        if not self.config["cache"] or not self._synced or not self._team:
+            return
+        # Cached values are replaced rather than modified in place, so a shallow copy is enough to
+        # serialise in another thread.
+        cache = {"version": self._cache_version,
+                 "team": self._team["id"],
+                 "bot": self._bot_user,
+                 "synced": self._synced,
+                 "users": [user.raw for user in self._users.values()],
+                 "channels": list(self._channels.values()),
+                 "directs": list(self._directs.values())}
+        self._cache_write = ensure_future(self._write_cache(cache, self._cache_write))
+
+    async def _write_cache(self, cache, previous=None):
+        # Writes happen in the background, but each waits for the last so that they land in order.
+        if previous:
+            await gather(previous, return_exceptions=True)
+        try:
+            await get_event_loop().run_in_executor(None, self._dump_cache, cache)
+        except OSError:
+            log.warning("Failed to write cache file %r", self.config["cache"], exc_info=True)
+
+    def _dump_cache(self, cache):
+        # Write to a temporary file first, to avoid leaving a partial file if interrupted.
+        temp = "{}.tmp".format(self.config["cache"])
+        with open(temp, "w") as file_:
+            json_dump(cache, file_)
+        os.replace(temp, self.config["cache"])
+
+    async def _sync(self):
         # Cache useful information about users and channels, to save on queries later.
-        reqs = (self._api("team.info", _Schema.team_info),
-                self._paged("users.list", _Schema.users_list, "members"),
+        log.debug("User %r refreshing workspace cache", self._bot_user)
+        known = set(self._channels) | set(self._directs)
+        reqs = (self._paged("users.list", _Schema.users_list, "members"),
                 self._paged("conversations.list", _Schema.convs_list, "channels",
                             params={"types": "public_channel,private_channel,mpim,im"}))
-        team, users, convs = await gather(*reqs)
-        self._team = team["team"]
-        self._users = {u["id"]: SlackUser.from_member(self, u) for u in users}
-        self._directs = {c["id"]: c for c in convs if c["is_im"]}
-        self._channels = {c["id"]: c for c in convs if c["id"] not in self._directs}
+        users, convs = await gather(*reqs)
+        self._users.update((u["id"], SlackUser.from_member(self, u)) for u in users)
+        # Merge rather than replace, to keep anything added by events whilst the refresh was in
+        # progress, but drop conversations we knew about beforehand that have since gone.
+        for id_ in known.difference(c["id"] for c in convs):
+            self._channels.pop(id_, None)
+            self._directs.pop(id_, None)
+        for conv in convs:
+            if conv["is_im"]:
+                self._directs[conv["id"]] = conv
+            else:
+                self._channels[conv["id"]] = conv
+        self._reindex()
+        self._synced = time.time()
         log.debug("User %r cached %d users, %d channels, %d IMs", self._bot_user,
                   len(self._users), len(self._channels), len(self._directs))
-        self._members = {}
-        self._bot_to_app = {}
+        self._save_cache()
+
+    def _reindex(self):
         # Create a map of bot IDs to users, as the bot cache doesn't contain references to them.
         self._bot_to_user = {user.bot_id: user.id for user in self._users.values() if user.bot_id}
+        self._usernames = {user.username: user.id for user in self._users.values()}
+        self._user_directs = {direct["user"]: direct["id"] for direct in self._directs.values()
+                              if direct.get("user")}
+
+    def _add_user(self, user):
+        old = self._users.get(user.id)
+        if old and self._usernames.get(old.username) == old.id:
+            del self._usernames[old.username]
+        self._users[user.id] = user
+        self._usernames[user.username] = user.id
+        if user.bot_id:
+            self._bot_to_user[user.bot_id] = user.id
+
+    def _add_direct(self, direct):
+        self._directs[direct["id"]] = direct
+        if direct.get("user"):
+            self._user_directs[direct["user"]] = direct["id"]
+
+    def _sync_done(self, task):
+        if self._syncing is task:
+            self._syncing = None
+        if not task.cancelled() and task.exception():
+            log.warning("User %r failed to refresh workspace cache", self._bot_user,
+                        exc_info=task.exception())
+            # Try again on the next connection.
+            self._refresh = True
+
+    async def _wait_sync(self):
+        # Lookups that need a complete view of the workspace wait for the first refresh.
+        if self._syncing and not self._synced:
+            await shield(self._syncing)
+
+    async def _rtm(self):
+        if not self._bot_user:
+            auth = await self._api("auth.test", _Schema.auth_test)
+            self._bot_user = auth["user_id"]
+        if not self._team:
+            team = await self._api("team.info", _Schema.team_info)
+            self._team = team["team"]
+            key = (self._team["id"], self._bot_user)
+            if self._cache_key != key:
+                # Don't reuse caches from another workspace or bot after a restart.
+                if self._cache_key:
+                    log.debug("Discarding cache for a different workspace or user")
+                    self._reset_cache()
+                self._cache_key = key
+            await self._load_cache()
+        # Reconnects reuse the existing cache, which is kept up-to-date by events whilst connected,
+        # and is only refreshed in full (in the background) once it's old, or after a restart.
+        if not self._syncing and (self._refresh or not self._synced or
+                                  time.time() - self._synced > self._cache_refresh):
+            self._refresh = False
+            self._syncing = ensure_future(self._sync())
+            self._syncing.add_done_callback(self._sync_done)
         log.debug("User %r requesting websocket session", self._bot_user)
         if self.config["app-token"]:
             rtm = await self._api("apps.connections.open", _Schema.socket_open, True)
@@ -937,7 +1163,16 @@ class SlackPlug(immp.Plug, immp.HTTPOpenable):
             log.debug("Closing websocket")
             await self._socket.close()
             self._socket = None
+        if self._syncing:
+            self._syncing.cancel()
+            self._syncing = None
+        self._save_cache()
+        if self._cache_write:
+            await self._cache_write
+            self._cache_write = None
         self._team = self._bot_user = None
+        # Events will be missed whilst stopped, so refresh once started again.
+        self._refresh = True
 
     async def user_from_id(self, id_):
         if id_ not in self._users:
@@ -946,42 +1181,47 @@ class SlackPlug(immp.Plug, immp.HTTPOpenable):
             except SlackAPIError:
                 return None
             else:
-                self._users[id_] = SlackUser.from_member(self, data["user"])
+                self._add_user(SlackUser.from_member(self, data["user"]))
         return self._users[id_]
 
     async def user_from_username(self, username):
-        for user in self._users.values():
-            if user.username == username:
-                return user
-        return None
+        await self._wait_sync()
+        try:
+            return self._users[self._usernames[username]]
+        except KeyError:
+            return None
 
     async def user_is_system(self, user):
         return user.id == self._bot_user
 
     async def public_channels(self):
+        await self._wait_sync()
         return [immp.Channel(self, id_) for id_ in self._channels]
 
     async def private_channels(self):
+        await self._wait_sync()
         return [immp.Channel(self, id_) for id_ in self._directs]
 
     async def channel_for_user(self, user):
         if not isinstance(user, SlackUser):
             return
-        for direct in self._directs.values():
-            if direct["user"] == user.id:
-                return immp.Channel(self, direct["id"])
+        await self._wait_sync()
+        if user.id in self._user_directs:
+            return immp.Channel(self, self._user_directs[user.id])
         # Private channel doesn't exist yet or isn't cached.
         params = {"users": user.id,
                   "return_im": "true"}
         opened = await self._api("conversations.open", _Schema.conv_open, params=params)
         channel = opened["channel"]
-        self._directs[channel["id"]] = channel
+        self._add_direct(channel)
         return immp.Channel(self, channel["id"])
 
     async def channel_is_private(self, channel):
+        await self._wait_sync()
         return channel.source in self._directs
 
     async def channel_title(self, channel):
+        await self._wait_sync()
         try:
             sl_channel = self._channels[channel.source]
         except KeyError:
@@ -1106,22 +1346,33 @@ class SlackPlug(immp.Plug, immp.HTTPOpenable):
         for attach in msg.attachments:
             if isinstance(attach, immp.File):
                 # Upload each file to Slack.
-                form = FormData({"channels": channel.source,
-                                 "filename": attach.title or ""})
+                fields = {"channels": channel.source,
+                          "filename": attach.title or ""}
                 if isinstance(parent.reply_to, immp.Receipt):
                     # Reply directly to the corresponding thread.  Note that thread_ts can be any
                     # message in the thread, it need not be resolved to the parent.
-                    form.add_field("thread_ts", msg.reply_to.id)
+                    fields["thread_ts"] = msg.reply_to.id
                     if self.config["thread-broadcast"]:
-                        form.add_field("broadcast", "true")
+                        fields["broadcast"] = "true"
                 if name:
                     comment = immp.RichText([immp.Segment(name, bold=True, italic=True,
                                                           link=msg.user.link),
                                              immp.Segment(" uploaded this file", italic=True)])
-                    form.add_field("initial_comment", SlackRichText.to_mrkdwn(self, comment))
-                img_resp = await attach.get_content(self.session)
-                form.add_field("file", img_resp.content, filename="file")
-                upload = await self._api("files.upload", _Schema.file_upload, data=form)
+                    fields["initial_comment"] = SlackRichText.to_mrkdwn(self, comment)
+                for attempt in range(self._rate_limit_retries + 1):
+                    # Form data is consumed by the request, so rebuild it for any retries, and
+                    # stream the file again from its source rather than holding it in memory.
+                    async with (await attach.get_content(self.session)) as img_resp:
+                        form = FormData(fields)
+                        form.add_field("file", img_resp.content, filename="file")
+                        try:
+                            upload = await self._api("files.upload", _Schema.file_upload,
+                                                     data=form)
+                        except SlackAPIRateLimitError:
+                            if attempt == self._rate_limit_retries:
+                                raise
+                        else:
+                            break
                 uploads += 1
                 for shared in upload["file"]["shares"].values():
                     if channel.source in shared:
@@ -1241,24 +1492,32 @@ class SlackPlug(immp.Plug, immp.HTTPOpenable):
             log.debug("User %r received a %r event", self._bot_user, event["type"])
             if event["type"] in ("team_join", "user_change"):
                 # A user appeared or changed, update our cache.
-                self._users[event["user"]["id"]] = SlackUser.from_member(self, event["user"])
+                self._add_user(SlackUser.from_member(self, event["user"]))
             elif event["type"] in ("channel_created", "channel_joined", "channel_rename",
                                    "group_created", "group_joined", "group_rename"):
                 # A group or channel appeared or updated, add to our cache.
-                if event["channel"]["id"] in self._channels:
-                    self._channels[event["channel"]["id"]].update(event["channel"])
-                else:
-                    self._channels[event["channel"]["id"]] = event["channel"]
+                channel = self._channels.get(event["channel"]["id"], {})
+                self._channels[event["channel"]["id"]] = dict(channel, **event["channel"])
             elif event["type"] == "im_created":
                 # A DM appeared, add to our cache.
-                self._directs[event["channel"]["id"]] = event["channel"]
+                direct = dict(event["channel"])
+                if event.get("user"):
+                    direct.setdefault("user", event["user"])
+                self._add_direct(direct)
             elif (event["type"] in ("channel_deleted", "group_deleted") and
                   event["channel"] in self._channels):
                 del self._channels[event["channel"]]
             elif event["type"] == "member_joined_channel" and event["channel"] in self._members:
-                self._members[event["channel"]].append(event["user"])
+                members = self._members[event["channel"]]
+                if event["user"] not in members:
+                    members.append(event["user"])
             elif event["type"] == "member_left_channel" and event["channel"] in self._members:
-                self._members[event["channel"]].remove(event["user"])
+                members = self._members[event["channel"]]
+                if event["user"] in members:
+                    members.remove(event["user"])
+                else:
+                    # The cached list is stale (e.g. a join was missed), so fetch it again.
+                    self._members.pop(event["channel"], None)
             elif event["type"] == "message" and not event["subtype"] == "message_replied":
                 # A new message arrived, push it back to the host.
                 try:
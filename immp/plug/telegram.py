@@ -25,6 +25,9 @@ Config:
         at a later date, you'll receive a backlog of any messages not yet picked up.
     session (str):
         Optional path to store a session file, used to cache access hashes.
+    state (str):
+        Optional path to store a JSON file of plug state (update offset, reusable file IDs and the
+        chat blacklist index), so that work already done isn't repeated after a restart.
     stickers (bool):
         ``True`` to include stickers in messages as proprietary-format attachments (.tgs files).
 
@@ -47,10 +50,15 @@ methods.  With a session file, you need only do this once, after which the refer
 "access hash") is cached.
 """
 
-from asyncio import CancelledError, TimeoutError, ensure_future, gather, sleep, wait
+from asyncio import (CancelledError, Event, TimeoutError, ensure_future, gather, get_event_loop,
+                     shield, sleep, wait_for)
 from collections import defaultdict
 from datetime import datetime, timezone
+from hashlib import sha1
+from json import dump as json_dump, load as json_load
 import logging
+import os
+import time
 
 from aiohttp import ClientError, ClientResponseError, FormData
 
@@ -76,6 +84,7 @@ class _Schema:
                           immp.Optional("api-hash"): immp.Nullable(str),
                           immp.Optional("client-updates", False): bool,
                           immp.Optional("session"): immp.Nullable(str),
+                          immp.Optional("state"): immp.Nullable(str),
                           immp.Optional("stickers", True): bool})
 
     user = immp.Schema({"id": int,
@@ -163,7 +172,9 @@ class _Schema:
         return immp.Schema(immp.Any(success,
                                     {"ok": False,
                                      "description": str,
-                                     "error_code": int}))
+                                     "error_code": int,
+                                     immp.Optional("parameters", dict):
+                                         {immp.Optional("retry_after"): immp.Nullable(int)}}))
 
 
 class TelegramAPIConnectError(immp.PlugError):
@@ -178,6 +189,131 @@ class TelegramAPIRequestError(immp.PlugError):
     """
 
 
+class TelegramAPIRateLimitError(TelegramAPIRequestError):
+    """
+    Rate limit exceeded in the Telegram API.
+
+    Attributes:
+        retry_after (int):
+            Number of seconds to wait before making another request.
+    """
+
+    def __init__(self, *args, retry_after=None):
+        super().__init__(*args)
+        self.retry_after = retry_after
+
+
+class _RateLimiter:
+    # Bot API limits for outgoing messages: around 30 per second overall, no more than 20 per minute
+    # in a single group, and around one per second in a single private chat.
+
+    def __init__(self):
+        self.overall = immp.TokenBucket(30, 30)
+        self.chats = {}
+
+    def _bucket(self, chat):
+        try:
+            return self.chats[chat]
+        except KeyError:
+            if int(chat) < 0:
+                bucket = immp.TokenBucket(20, 20 / 60)
+            else:
+                bucket = immp.TokenBucket(1, 1)
+            self.chats[chat] = bucket
+            return bucket
+
+    async def wait(self, chat):
+        bucket = self._bucket(str(chat))
+        await bucket.acquire()
+        await self.overall.acquire()
+        # Drop idle buckets once they've fully refilled, as they're equivalent to new ones.
+        for key in [key for key, bucket in self.chats.items() if bucket.full]:
+            del self.chats[key]
+
+    def pause(self, chat, delay):
+        self._bucket(str(chat)).pause(delay)
+
+    @property
+    def depth(self):
+        return {chat: bucket.waiting for chat, bucket in self.chats.items() if bucket.waiting}
+
+
+class _StateFile:
+    # Small JSON document for persisting data between runs.  Without a path, it just holds the data
+    # in memory for the current session.  Saves are batched up over a short delay, and written out
+    # in the background so as not to block the event loop.
+
+    def __init__(self, path=None, delay=5):
+        self.path = path
+        self.delay = delay
+        self.data = {}
+        self._dirty = False
+        self._task = None
+        self._now = Event()
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as file_:
+                self.data = json_load(file_)
+        except FileNotFoundError:
+            log.debug("No existing state file at %r", self.path)
+        except (OSError, ValueError):
+            log.warning("Failed to read state file %r", self.path, exc_info=True)
+        self._dirty = False
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        if self.data.get(key) != value:
+            self.data[key] = value
+            self._dirty = True
+
+    def save(self):
+        if not self.path or not self._dirty or self._task:
+            return
+        self._task = ensure_future(self._save_later())
+
+    async def flush(self):
+        # Write out any pending changes now, rather than waiting for the delay.
+        self.save()
+        if not self._task:
+            return
+        self._now.set()
+        await shield(self._task)
+
+    async def _save_later(self):
+        try:
+            # Wait out the delay, unless a flush is requested in the meantime.
+            await wait_for(self._now.wait(), self.delay)
+        except TimeoutError:
+            pass
+        try:
+            # Values are replaced rather than modified in place, so a shallow copy is enough to
+            # serialise in another thread.  Changes made during a write trigger another one.
+            while self._dirty:
+                data = dict(self.data)
+                self._dirty = False
+                try:
+                    await get_event_loop().run_in_executor(None, self._write, data)
+                except OSError:
+                    log.warning("Failed to write state file %r", self.path, exc_info=True)
+                    self._dirty = True
+                    break
+        finally:
+            self._task = None
+            self._now.clear()
+
+    def _write(self, data):
+        # Write to a temporary file first, to avoid leaving a partial file if interrupted.
+        temp = "{}.tmp".format(self.path)
+        with open(temp, "w") as file_:
+            json_dump(data, file_)
+        os.replace(temp, self.path)
+
+
 class _HiddenSender:
 
     # @HiddenSender, "a user": author of message forwards when opted to be linked back to them.
@@ -476,9 +612,17 @@ class TelegramRichText(immp.RichText):
             return immp.RichText([immp.Segment(text)])
         # Telegram entities assume the text is UTF-16.
         encoded = text.encode("utf-16-le")
+        # Entities have already been validated as part of their parent message.  Resolve all
+        # mentioned usernames together, rather than one at a time.
+        usernames = set()
+        for entity in entities:
+            if entity["type"] == "mention":
+                start = (entity["offset"] + 1) * 2
+                end = (entity["offset"] + entity["length"]) * 2
+                usernames.add(encoded[start:end].decode("utf-16-le"))
+        mentions = await telegram._users_from_usernames(usernames) if usernames else {}
         changes = defaultdict(dict)
-        for json in entities:
-            entity = _Schema.entity(json)
+        for entity in entities:
             start = entity["offset"] * 2
             end = start + (entity["length"] * 2)
             if entity["type"] in ("bold", "italic", "underline", "code", "pre"):
@@ -499,7 +643,7 @@ class TelegramRichText(immp.RichText):
             elif entity["type"] == "mention":
                 key = "mention"
                 username = encoded[start + 2:end].decode("utf-16-le")
-                value = await telegram.user_from_username(username)
+                value = mentions.get(username)
             elif entity["type"] == "text_mention":
                 key = "mention"
                 value = TelegramUser.from_bot_user(telegram, entity["user"])
@@ -531,6 +675,16 @@ class TelegramRichText(immp.RichText):
             return None
         elif not entities:
             return immp.RichText([immp.Segment(text)])
+        # Resolve all mentioned users together, rather than one at a time.
+        usernames = set()
+        ids = set()
+        for entity in entities:
+            if isinstance(entity, tl.types.MessageEntityMention):
+                usernames.add(text[entity.offset + 1:entity.offset + entity.length])
+            elif isinstance(entity, tl.types.MessageEntityMentionName):
+                ids.add(entity.user_id)
+        by_username, by_id = await gather(telegram._users_from_usernames(usernames),
+                                          telegram._users_from_ids(ids))
         changes = defaultdict(dict)
         for entity in entities:
             value = True
@@ -558,10 +712,10 @@ class TelegramRichText(immp.RichText):
             elif isinstance(entity, tl.types.MessageEntityMention):
                 key = "mention"
                 username = text[entity.offset + 1:entity.offset + entity.length]
-                value = await telegram.user_from_username(username)
+                value = by_username.get(username)
             elif isinstance(entity, tl.types.MessageEntityMentionName):
                 key = "mention"
-                value = await telegram.user_from_id(entity.user_id)
+                value = by_id.get(entity.user_id)
             else:
                 continue
             clear = False if value is True else None
@@ -576,7 +730,8 @@ class TelegramFile(immp.File):
     """
 
     @classmethod
-    async def from_proto_file(cls, telegram, file_, type_=immp.File.Type.unknown, name=None):
+    async def from_proto_file(cls, telegram, file_, type_=immp.File.Type.unknown, name=None,
+                              kind=None):
         try:
             file_id = pack_bot_file_id(file_)
         except Exception as e:
@@ -584,10 +739,10 @@ class TelegramFile(immp.File):
             log.warning("Failed to generate file ID for attachment", exc_info=e)
             return immp.File(name, type_)
         else:
-            return await cls.from_id(telegram, file_id, type_)
+            return await cls.from_id(telegram, file_id, type_, name, kind)
 
     @classmethod
-    async def from_id(cls, telegram, id_, type_=immp.File.Type.unknown, name=None):
+    async def from_id(cls, telegram, id_, type_=immp.File.Type.unknown, name=None, kind=None):
         """
         Generate a file using the bot API URL for a Telegram file.
 
@@ -600,6 +755,9 @@ class TelegramFile(immp.File):
                 Corresponding file type.
             name (str):
                 Original filename, if available for the file format.
+            kind (str):
+                Bot API upload field (``photo``, ``video`` or ``document``) that accepts this ID,
+                so that the file can be reused if relayed back into Telegram.
 
         Returns:
             .TelegramFile:
@@ -614,6 +772,8 @@ class TelegramFile(immp.File):
         else:
             url = ("https://api.telegram.org/file/bot{}/{}"
                    .format(telegram.config["token"], file_["file_path"]))
+            if kind:
+                telegram._remember_file(kind, url, id_)
             return immp.File(name, type_, url)
 
 
@@ -698,7 +858,7 @@ class TelegramMessage(immp.Message):
             text = "changed group photo"
             photo = max(message["new_chat_photo"], key=lambda photo: photo["height"])
             attachments.append(await TelegramFile.from_id(telegram, photo["file_id"],
-                                                          immp.File.Type.image))
+                                                          immp.File.Type.image, kind="photo"))
         elif message["delete_chat_photo"]:
             action = True
             text = "removed group photo"
@@ -710,7 +870,7 @@ class TelegramMessage(immp.Message):
             # This is a list of resolutions, find the original sized one to return.
             photo = max(message["photo"], key=lambda photo: photo["height"])
             attachments.append(await TelegramFile.from_id(telegram, photo["file_id"],
-                                                          immp.File.Type.image))
+                                                          immp.File.Type.image, kind="photo"))
             if message["caption"]:
                 text = await TelegramRichText.from_bot_entities(telegram, message["caption"],
                                                                 message["caption_entities"])
@@ -736,8 +896,9 @@ class TelegramMessage(immp.Message):
                 type_ = immp.File.Type.video
             else:
                 type_ = immp.File.Type.unknown
+            kind = key if key in ("video", "document") else None
             attachments.append(await TelegramFile.from_id(telegram, obj["file_id"], type_,
-                                                          obj["file_name"]))
+                                                          obj["file_name"], kind))
             if message["caption"]:
                 text = await TelegramRichText.from_bot_entities(telegram, message["caption"],
                                                                 message["caption_entities"])
@@ -882,7 +1043,7 @@ class TelegramMessage(immp.Message):
             reply_to = await telegram.resolve_message(receipt)
         if message.photo:
             attach = await TelegramFile.from_proto_file(telegram, message.photo,
-                                                        immp.File.Type.image)
+                                                        immp.File.Type.image, kind="photo")
             attachments.append(attach)
         elif message.document:
             type_ = immp.File.Type.unknown
@@ -1034,12 +1195,31 @@ if SQLiteSession:
         def get_chat_entities(self):
             return self._execute_multi("SELECT id, username, name FROM entities WHERE id < 0")
 
+        def _execute_in(self, statement, values):
+            # SQLite limits the number of parameters in a single query, so split up large lookups.
+            values = list(values)
+            rows = []
+            for pos in range(0, len(values), 500):
+                chunk = values[pos:pos + 500]
+                rows += self._execute_multi(statement.format(", ".join("?" * len(chunk))), *chunk)
+            return rows
+
         def get_entity(self, id_):
             return self._execute("SELECT id, username, name FROM entities WHERE id = ?", id_)
 
+        def get_entities(self, ids):
+            return self._execute_in("SELECT id, username, name FROM entities WHERE id IN ({})",
+                                    ids)
+
         def get_entity_username(self, username):
+            # Usernames are case-insensitive, and stored in lowercase.
             return self._execute("SELECT id, username, name FROM entities WHERE username = ?",
-                                 username)
+                                 username.lower())
+
+        def get_entities_username(self, usernames):
+            return self._execute_in("SELECT id, username, name FROM entities "
+                                    "WHERE username IN ({})",
+                                    (username.lower() for username in usernames))
 
 
 class TelegramPlug(immp.Plug, immp.HTTPOpenable):
@@ -1051,6 +1231,16 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
 
     network_name = "Telegram"
 
+    # Full blacklist indexing is repeated periodically, to catch entities whose access has changed.
+    _blacklist_refresh = 7 * 24 * 60 * 60
+    # Number of concurrent lookups, and lookups per second, when indexing the blacklist.
+    _blacklist_workers = 5
+    _blacklist_rate = 10
+    # Number of consecutive empty batches to allow when iterating history in the shared sequence.
+    _history_gap = 10
+    # Number of times to retry a rate limited send before giving up.
+    _rate_limit_retries = 3
+
     @property
     def network_id(self):
         return "telegram:{}".format(self._bot_user["id"]) if self._bot_user else None
@@ -1068,20 +1258,57 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
         self._closing = False
         # Temporary tracking of migrated chats for the current session.
         self._migrations = {}
-        # Caching of user/username lookups to avoid flooding.
-        self._users = {}
-        self._usernames = {}
+        # Caching of user/username lookups to avoid flooding, including failed lookups.
+        self._users = immp.LRUCache(1000, 3600)
+        self._usernames = immp.LRUCache(1000, 3600)
         # Blacklist of channels we have an entity for but can't access.  Indexed at startup, with
         # chats removed if we receive a message from that channel.
         self._blacklist = set()
         self._blacklist_task = None
+        # Entities already checked for the blacklist, so that later runs need only check new ones.
+        self._indexed = set()
+        # Mapping from group chat IDs to their members, keyed by user ID.  Updated with joins and
+        # leaves as they happen, and refreshed in full periodically in case any were missed.
+        self._members = immp.LRUCache(100, 6 * 60 * 60)
+        self._members_fetch = {}
+        # Throttling of outgoing messages, to stay within the bot API's flood limits.
+        self._limiter = _RateLimiter()
         # Update ID from which to retrieve the next batch.  Should be one higher than the max seen.
         self._offset = 0
         # Private chats and non-super groups have a shared incremental message ID.  Cache the
         # highest we've seen, so that we can attempt to fetch past messages with this as a base.
         self._last_id = None
+        # Mapping from upload field and file source to a bot API file ID, so that attachments
+        # relayed more than once can reuse the existing file instead of being uploaded again.
+        self._file_ids = immp.LRUCache(1000)
+        # Persistence of the above between runs, saved shortly after each batch of updates.
+        self._state = _StateFile(self.config["state"])
 
-    async def _api(self, endpoint, type_=None, quiet=False, **kwargs):
+    @property
+    def send_queue(self):
+        """
+        Number of outgoing requests currently held back by rate limiting, keyed by chat ID.
+        """
+        return self._limiter.depth
+
+    async def _api(self, endpoint, type_=None, quiet=False, chat=None, **kwargs):
+        # Requests targeting a chat are throttled and retried a few times when rate limited, though
+        # form data can only be sent once, so the caller must rebuild and retry those itself.
+        # Other requests aren't sends, so a rate limit is raised without holding up the limiter.
+        for attempt in range(self._rate_limit_retries + 1):
+            if chat:
+                await self._limiter.wait(chat)
+            try:
+                return await self._api_request(endpoint, type_, quiet, **kwargs)
+            except TelegramAPIRateLimitError as e:
+                log.debug("Rate limited on %r for %d seconds", endpoint, e.retry_after)
+                if not chat:
+                    raise
+                self._limiter.pause(chat, e.retry_after)
+                if isinstance(kwargs.get("data"), FormData) or attempt == self._rate_limit_retries:
+                    raise
+
+    async def _api_request(self, endpoint, type_=None, quiet=False, **kwargs):
         url = "https://api.telegram.org/bot{}/{}".format(self.config["token"], endpoint)
         if not quiet:
             log.debug("Making API request to %r", endpoint)
@@ -1098,14 +1325,34 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
             raise TelegramAPIConnectError("Request failed") from e
         except TimeoutError as e:
             raise TelegramAPIConnectError("Request timed out") from e
-        if not data["ok"]:
+        if data["ok"]:
+            return data["result"]
+        elif data["error_code"] == 429 and data["parameters"]["retry_after"]:
+            raise TelegramAPIRateLimitError(data["error_code"], data["description"],
+                                            retry_after=data["parameters"]["retry_after"])
+        else:
             raise TelegramAPIRequestError(data["error_code"], data["description"])
-        return data["result"]
+
+    def _save_state(self):
+        if not self._bot_user:
+            return
+        self._state.set("bot", self._bot_user["id"])
+        self._state.set("offset", self._offset)
+        self._state.set("last_id", self._last_id)
+        self._state.save()
 
     async def start(self):
         await super().start()
         self._closing = False
         self._bot_user = await self._api("getMe", _Schema.user)
+        self._state.load()
+        if self._state.get("bot", self._bot_user["id"]) != self._bot_user["id"]:
+            # Offsets and IDs are only valid for the bot that saw them.
+            log.debug("Discarding state from a different bot")
+            self._state.data.clear()
+        self._offset = self._state.get("offset", 0)
+        self._last_id = self._state.get("last_id")
+        self._file_ids.update(self._state.get("files", {}))
         if self.config["api-id"] and self.config["api-hash"]:
             if not TelegramClient:
                 raise immp.ConfigError("API ID/hash specified but Telethon is not installed")
@@ -1134,8 +1381,7 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
             elif diff.new_messages:
                 self._last_id = diff.new_messages[-1].id
             self._blacklist = {_HiddenSender.hidden_channel_id}
-            self._blacklist_task = ensure_future(wait([self._blacklist_users(),
-                                                       self._blacklist_chats()]))
+            self._blacklist_task = ensure_future(self._blacklist_index())
 
     async def stop(self):
         await super().stop()
@@ -1148,12 +1394,16 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
             log.debug("Closing client")
             await self._client.disconnect()
             self._client = None
+        self._save_state()
+        await self._state.flush()
         self._bot_user = None
         if self._blacklist:
             self._blacklist.clear()
         if self._blacklist_task:
             self._blacklist_task.cancel()
             self._blacklist_task = None
+        self._indexed.clear()
+        self._members.clear()
         self._offset = 0
         self._last_id = None
         if self._migrations:
@@ -1167,19 +1417,38 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
         entity = self._client.session.get_entity(id_)
         if entity:
             return TelegramUser.from_entity(self, entity)
-        elif id_ in self._users:
+        try:
             return self._users[id_]
+        except KeyError:
+            pass
         try:
             data = await self._client(tl.functions.users.GetFullUserRequest(id_))
         except ValueError:
             log.warning("Missing entity for user %d", id_)
             return None
         except BadRequestError:
-            return None
-        user = TelegramUser.from_proto_user(self, data.user)
+            user = None
+        else:
+            user = TelegramUser.from_proto_user(self, data.user)
         self._users[id_] = user
         return user
 
+    async def _users_from_ids(self, ids):
+        # Batch equivalent of user_from_id(): a single session query for all known users, then
+        # concurrent lookups for the remainder.
+        if not ids:
+            return {}
+        elif not self._client:
+            log.debug("Client auth required to look up users")
+            return {}
+        users = {}
+        for entity in self._client.session.get_entities(int(id_) for id_ in ids):
+            users[entity[0]] = TelegramUser.from_entity(self, entity)
+        missing = [id_ for id_ in ids if int(id_) not in users]
+        found = await gather(*(self.user_from_id(id_) for id_ in missing))
+        users.update((int(id_), user) for id_, user in zip(missing, found))
+        return {id_: users[int(id_)] for id_ in ids}
+
     async def user_from_username(self, username):
         if not self._client:
             log.debug("Client auth required to look up users")
@@ -1187,57 +1456,146 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
         entity = self._client.session.get_entity_username(username)
         if entity:
             return TelegramUser.from_entity(self, entity)
-        elif username in self._usernames:
-            return self._usernames[username]
+        try:
+            return self._usernames[username.lower()]
+        except KeyError:
+            pass
         try:
             data = await self._client(tl.functions.contacts.ResolveUsernameRequest(username))
         except BadRequestError:
-            return None
-        if not data.users:
-            return None
-        user = TelegramUser.from_proto_user(self, data.users[0])
-        self._usernames[username] = user
+            user = None
+        else:
+            user = TelegramUser.from_proto_user(self, data.users[0]) if data.users else None
+        self._usernames[username.lower()] = user
         return user
 
+    async def _users_from_usernames(self, usernames):
+        # Batch equivalent of user_from_username(), as with _users_from_ids().
+        if not usernames:
+            return {}
+        elif not self._client:
+            log.debug("Client auth required to look up users")
+            return {}
+        users = {}
+        for entity in self._client.session.get_entities_username(usernames):
+            users[entity[1].lower()] = TelegramUser.from_entity(self, entity)
+        missing = [username for username in usernames if username.lower() not in users]
+        found = await gather(*(self.user_from_username(username) for username in missing))
+        users.update((username.lower(), user) for username, user in zip(missing, found))
+        return {username: users[username.lower()] for username in usernames}
+
     async def user_is_system(self, user):
         return user.id == str(self._bot_user["id"])
 
-    async def _blacklist_users(self):
+    def _blacklist_progress(self, ids):
+        # Progress is written out with the next batched state save, not on every call.
+        self._indexed.update(ids)
+        self._state.set("indexed", sorted(self._indexed))
+        self._state.set("blacklist", sorted(self._blacklist))
+        self._save_state()
+
+    async def _blacklist_index(self):
+        # Checking every cached entity takes a long time for large sessions.  Resume from previous
+        # runs where possible, and only check entities that are new since then.
+        now = int(time.time())
+        if now - self._state.get("blacklist_at", 0) > self._blacklist_refresh:
+            log.debug("Starting full blacklist index")
+            self._indexed = set()
+            self._state.set("blacklist_at", now)
+            self._blacklist_progress(())
+        else:
+            self._indexed = set(self._state.get("indexed", []))
+            self._blacklist.update(self._state.get("blacklist", []))
+        users = [user[0] for user in self._client.session.get_user_entities()
+                 if user[0] not in self._indexed]
+        chats = [chat[0] for chat in self._client.session.get_chat_entities()
+                 if chat[0] not in self._indexed and chat[0] not in self._blacklist]
+        log.debug("Checking %d users and %d chats for blacklist", len(users), len(chats))
+        # Lookups share a rate limit, to avoid competing with live traffic.
+        limit = immp.TokenBucket(self._blacklist_rate, self._blacklist_rate)
+        await gather(self._blacklist_users(users, limit), self._blacklist_chats(chats, limit))
+
+    async def _blacklist_user(self, id_, limit):
+        while True:
+            async with limit:
+                try:
+                    # Bypass the send limiter, so that a rate limit here only slows the indexer,
+                    # and doesn't hold up live messages.
+                    await self._api_request("getChat", _Schema.chat, quiet=True,
+                                            params={"chat_id": id_})
+                except TelegramAPIRateLimitError as e:
+                    limit.pause(e.retry_after)
+                except TelegramAPIRequestError:
+                    return True
+                else:
+                    return False
+
+    async def _blacklist_users(self, ids, limit):
         # For each user in the entity table, check the bot API for a corresponding chat, and
         # blacklist those who haven't started a conversation with us yet.
-        log.debug("Finding users to blacklist")
         count = 0
-        for user in self._client.session.get_user_entities():
-            try:
-                await self._api("getChat", _Schema.chat, quiet=True, params={"chat_id": user[0]})
-            except TelegramAPIRequestError:
-                count += 1
-                self._blacklist.add(user[0])
+        pending = iter(ids)
+        checked = []
+
+        async def worker():
+            nonlocal count
+            # Workers share an iterator, which caps the number of requests in flight.
+            for id_ in pending:
+                try:
+                    blocked = await self._blacklist_user(id_, limit)
+                except TelegramAPIConnectError:
+                    log.debug("Failed to check user %d for blacklist", id_, exc_info=True)
+                    continue
+                if blocked:
+                    count += 1
+                    self._blacklist.add(id_)
+                checked.append(id_)
+                if len(checked) >= 500:
+                    self._blacklist_progress(checked)
+                    checked.clear()
+
+        await gather(*(worker() for _ in range(self._blacklist_workers)))
+        self._blacklist_progress(checked)
         log.debug("Blacklisted %d users", count)
 
-    async def _blacklist_chats(self):
+    async def _blacklist_channels(self, ids, limit):
+        # Look up channels in bulk, returning those we can't access.  A single private channel can
+        # fail the whole batch, in which case fall back to checking each one individually.
+        async with limit:
+            try:
+                data = await self._client(tl.functions.channels.GetChannelsRequest(
+                    [abs(id_) for id_ in ids]))
+            except ChannelPrivateError:
+                if len(ids) == 1:
+                    return ids
+            else:
+                return [int("-100{}".format(chat.id)) for chat in data.chats
+                        if isinstance(chat, tl.types.ChannelForbidden)]
+        gone = []
+        for id_ in ids:
+            gone += await self._blacklist_channels([id_], limit)
+        return gone
+
+    async def _blacklist_chats(self, ids, limit):
         # The entity cache is polluted with channels we've seen outside of participation (e.g.
         # mentions and forwards).  Narrow down the list by excluding chats we can't access.
-        log.debug("Finding chats to blacklist")
         count = 0
-        lookup = []
-        for chat in self._client.session.get_chat_entities():
-            if chat[0] in self._blacklist:
-                continue
-            if str(chat[0]).startswith("-100"):
-                try:
-                    await self._client(tl.functions.channels.GetChannelsRequest([abs(chat[0])]))
-                except ChannelPrivateError:
-                    count += 1
-                    self._blacklist.add(chat[0])
-            else:
-                lookup.append(abs(chat[0]))
+        channels = [id_ for id_ in ids if str(id_).startswith("-100")]
+        lookup = [abs(id_) for id_ in ids if not str(id_).startswith("-100")]
+        for pos in range(0, len(channels), 100):
+            batch = channels[pos:pos + 100]
+            gone = await self._blacklist_channels(batch, limit)
+            count += len(gone)
+            self._blacklist.update(gone)
+            self._blacklist_progress(batch)
         if lookup:
-            chats = await self._client(tl.functions.messages.GetChatsRequest(lookup))
+            async with limit:
+                chats = await self._client(tl.functions.messages.GetChatsRequest(lookup))
             gone = [-chat.id for chat in chats.chats if isinstance(chat, tl.types.ChatForbidden)]
             if gone:
                 count += len(gone)
                 self._blacklist.update(gone)
+            self._blacklist_progress(-id_ for id_ in lookup)
         log.debug("Blacklisted %d chats", count)
 
     async def public_channels(self):
@@ -1258,6 +1616,7 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
         ids = set(chat[0] for chat in self._client.session.get_user_entities())
         return [immp.Channel(self, chat) for chat in ids - self._blacklist]
 
+    @immp.cached(1000, 10 * 60, negative=False)
     async def channel_for_user(self, user):
         if not isinstance(user, TelegramUser):
             return None
@@ -1273,6 +1632,7 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
     async def channel_is_private(self, channel):
         return int(channel.source) > 0
 
+    @immp.cached(1000, 60 * 60, negative=False)
     async def channel_title(self, channel):
         if await channel.is_private():
             return None
@@ -1304,15 +1664,31 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
                 if entity:
                     return [TelegramUser.from_bot_user(self, self._bot_user),
                             await self.user_from_id(channel.source)]
+        # Group member lists are cached, and kept up-to-date using join and leave messages.
+        try:
+            members = self._members[channel.source]
+        except KeyError:
+            fetch = self._members_fetch.get(channel.source)
+            if not fetch:
+                # Share a single fetch between concurrent callers.
+                fetch = ensure_future(self._fetch_members(channel.source))
+                fetch.add_done_callback(lambda _: self._members_fetch.pop(channel.source, None))
+                self._members_fetch[channel.source] = fetch
+            members = await shield(fetch)
+        return list(members.values()) if members is not None else None
+
+    async def _fetch_members(self, source):
         # Channel and supergroup chat IDs have a bot-API-only prefix to distinguish them.
-        if channel.source.startswith("-100"):
-            chat = int(channel.source[4:])
+        if source.startswith("-100"):
+            chat = int(source[4:])
             users = []
+            offset = 0
             try:
                 while True:
                     data = await self._client(tl.functions.channels.GetParticipantsRequest(
-                        chat, tl.types.ChannelParticipantsRecent(), len(users), 1000, 0))
+                        chat, tl.types.ChannelParticipantsRecent(), offset, 1000, 0))
                     if data.users:
+                        offset += len(data.users)
                         users += [TelegramUser.from_proto_user(self, user) for user in data.users
                                   if not _HiddenSender.has(user.id)]
                     else:
@@ -1322,10 +1698,8 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
                 return None
             except BadRequestError:
                 return None
-            else:
-                return users
         else:
-            chat = abs(int(channel.source))
+            chat = abs(int(source))
             try:
                 data = await self._client(tl.functions.messages.GetFullChatRequest(chat))
             except ValueError:
@@ -1333,8 +1707,10 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
                 return None
             except BadRequestError:
                 return None
-            else:
-                return [TelegramUser.from_proto_user(self, user) for user in data.users]
+            users = [TelegramUser.from_proto_user(self, user) for user in data.users]
+        members = {user.id: user for user in users}
+        self._members[source] = members
+        return members
 
     async def channel_admins(self, channel):
         if await channel.is_private():
@@ -1380,40 +1756,51 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
             await self._api("exportChatInviteLink", params={"chat_id": channel.source})
             log.debug("Regenerated invite link for %r", channel.source)
 
+    async def _history_start(self, channel):
+        # Telegram channels (including supergroups) have their own message ID sequence starting from
+        # 1.  Each user has a shared ID sequence used for non-super groups and private chats.
+        if channel.source.startswith("-100"):
+            request = tl.functions.channels.GetFullChannelRequest(int(channel.source))
+            chat = await self._client(request)
+            # The following behaviour has been observed:
+            # * Supergroups have a read_outbox_max_id equal to the latest message ID.
+            # * Channels that the authenticated user is a member of have a read_outbox_max_id of
+            #   zero, and an unread_count equal to the latest message ID.
+            # * Channels we're not a member of have no information (all counts zero).
+            last = chat.full_chat.read_outbox_max_id or chat.full_chat.unread_count
+            if not last:
+                log.debug("No unread or outbox message counts for chat: %s", channel.source)
+                return None
+            return immp.Receipt("{}:{}".format(channel.source, last + 1), channel)
+        elif self._last_id:
+            return immp.Receipt("{}:{}".format(channel.source, self._last_id + 1), channel)
+        else:
+            log.debug("Before message reference required to retrieve messages for chat: %s",
+                      channel.source)
+            return None
+
+    @classmethod
+    def _history_size(cls, channel):
+        # For a channel-private sequence, we can just retrieve the last batch of messages.  For the
+        # shared sequence, we can't lookup for a specific chat, so we instead fetch a larger batch
+        # (maxes out at 200) and filter to messages from the target chat.
+        return 50 if channel.source.startswith("-100") else 200
+
+    async def _history_range(self, chat, start, end):
+        ids = list(range(start, end))
+        return list(filter(None, await self._client.get_messages(entity=chat, ids=ids)))
+
     async def channel_history(self, channel, before=None):
         if not self._client:
             log.debug("Client auth required to retrieve messages")
             return []
-        # Telegram channels (including supergroups) have their own message ID sequence starting from
-        # 1.  Each user has a shared ID sequence used for non-super groups and private chats.
-        private_seq = channel.source.startswith("-100")
         if not before:
-            if private_seq:
-                request = tl.functions.channels.GetFullChannelRequest(int(channel.source))
-                chat = await self._client(request)
-                # The following behaviour has been observed:
-                # * Supergroups have a read_outbox_max_id equal to the latest message ID.
-                # * Channels that the authenticated user is a member of have a read_outbox_max_id of
-                #   zero, and an unread_count equal to the latest message ID.
-                # * Channels we're not a member of have no information (all counts zero).
-                last = chat.full_chat.read_outbox_max_id or chat.full_chat.unread_count
-                if not last:
-                    log.debug("No unread or outbox message counts for chat: %s", channel.source)
-                    return []
-                before = immp.Receipt("{}:{}".format(channel.source, last + 1), channel)
-            elif self._last_id:
-                before = immp.Receipt("{}:{}".format(channel.source, self._last_id + 1), channel)
-            else:
-                log.debug("Before message reference required to retrieve messages for chat: %s",
-                          channel.source)
+            before = await self._history_start(channel)
+            if not before:
                 return []
         chat, message = (int(field) for field in before.id.split(":", 1))
-        # For a channel-private sequence, we can just retrieve the last batch of messages.  For the
-        # shared sequence, we can't lookup for a specific chat, so we instead fetch a larger batch
-        # (maxes out at 200) and filter to messages from the target chat.
-        limit = 50 if private_seq else 200
-        ids = list(range(max(message - limit, 1), message))
-        history = filter(None, await self._client.get_messages(entity=chat, ids=ids))
+        start = max(message - self._history_size(channel), 1)
+        history = await self._history_range(chat, start, message)
         tasks = (TelegramMessage.from_proto_message(self, message) for message in history)
         results = await gather(*tasks, return_exceptions=True)
         messages = []
@@ -1426,6 +1813,55 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
                 messages.append(result)
         return messages
 
+    async def channel_iter_history(self, channel, before=None, limit=None, since=None):
+        if not self._client:
+            log.debug("Client auth required to retrieve messages")
+            return
+        if not before:
+            before = await self._history_start(channel)
+            if not before:
+                return
+        chat, end = (int(field) for field in before.id.split(":", 1))
+        size = self._history_size(channel)
+        shared_seq = not channel.source.startswith("-100")
+        count = empty = 0
+        fetch = None
+        try:
+            start = max(end - size, 1)
+            fetch = ensure_future(self._history_range(chat, start, end))
+            while fetch:
+                history = await fetch
+                # Fetch the next range of IDs in the background, and parse messages in this range
+                # only as they're consumed.
+                end, start = start, max(start - size, 1)
+                fetch = ensure_future(self._history_range(chat, start, end)) if end > 1 else None
+                if history:
+                    empty = 0
+                elif shared_seq:
+                    # The shared sequence may have long runs of messages from other chats, but
+                    # give up rather than walk all the way back to the first message.
+                    empty += 1
+                    if empty >= self._history_gap:
+                        log.debug("No recent messages in shared sequence for chat: %s",
+                                  channel.source)
+                        return
+                for message in reversed(history):
+                    if since and message.date < since:
+                        return
+                    try:
+                        sent = await TelegramMessage.from_proto_message(self, message)
+                    except NotImplementedError:
+                        continue
+                    yield sent
+                    count += 1
+                    if limit and count >= limit:
+                        return
+        finally:
+            if fetch and not fetch.done():
+                fetch.cancel()
+            elif fetch and not fetch.cancelled():
+                fetch.exception()
+
     async def get_message(self, receipt):
         if not self._client:
             log.debug("Client auth required to retrieve messages")
@@ -1441,18 +1877,86 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
         except NotImplementedError:
             return None
 
-    async def _form_data(self, base, field, attach):
-        data = FormData(base)
+    def _prefetch(self, attach, fetches):
+        # Files without a public URL need re-uploading.  Start downloading them straight away, so
+        # that they're ready to stream by the time the preceding messages have been sent.
         if attach.source:
+            return None
+        fetch = ensure_future(attach.get_content(self.session))
+        fetches.append(fetch)
+        return fetch
+
+    @classmethod
+    def _file_key(cls, field, source):
+        # Sources may be bot API URLs that include the token, so don't store them directly.
+        return "{}:{}".format(field, sha1(source.encode("utf-8")).hexdigest())
+
+    def _remember_file(self, field, source, file_id):
+        key = self._file_key(field, source)
+        if self._file_ids.get(key) != file_id:
+            self._file_ids[key] = file_id
+            self._save_files()
+
+    def _save_files(self):
+        # Only copy the file ID map when it changes, and leave the write to the next batched save.
+        self._state.set("files", dict(self._file_ids))
+        self._save_state()
+
+    @classmethod
+    def _sent_file_id(cls, message, field):
+        if field == "photo" and message["photo"]:
+            return max(message["photo"], key=lambda photo: photo["height"])["file_id"]
+        elif field != "photo" and message[field]:
+            return message[field]["file_id"]
+        else:
+            return None
+
+    async def _form_data(self, base, field, attach, fetch=None, file_id=None):
+        data = FormData(base)
+        if file_id:
+            data.add_field(field, file_id)
+        elif attach.source:
             data.add_field(field, attach.source)
         else:
-            img_resp = await attach.get_content(self.session)
+            img_resp = await (fetch or attach.get_content(self.session))
             data.add_field(field, img_resp.content, filename=attach.title or field)
         return data
 
-    async def _upload_attachment(self, chat, msg, attach, reply_to=None, caption=None):
+    async def _send_file(self, endpoint, field, base, attach, fetch=None):
+        # Form data can only be sent once, so needs rebuilding if the upload gets rate limited.
+        key = self._file_key(field, attach.source) if attach.source else None
+        retries = 0
+        while True:
+            file_id = self._file_ids.get(key) if key else None
+            data = await self._form_data(base, field, attach, fetch, file_id)
+            if not file_id:
+                fetch = None
+            try:
+                result = await self._api(endpoint, _Schema.message, chat=base["chat_id"],
+                                         data=data)
+            except TelegramAPIRateLimitError:
+                if retries == self._rate_limit_retries:
+                    raise
+                retries += 1
+                log.debug("Retrying rate-limited %s upload", field)
+            except TelegramAPIRequestError:
+                if not file_id:
+                    raise
+                # The file may have since been removed, fall back to the original source.
+                log.debug("Failed to reuse %s file ID, uploading again", field)
+                if self._file_ids.pop(key, None):
+                    self._save_files()
+            else:
+                sent_id = self._sent_file_id(result, field) if key and not file_id else None
+                if sent_id:
+                    self._file_ids[key] = sent_id
+                    self._save_files()
+                return result
+
+    async def _upload_attachment(self, chat, msg, attach, reply_to=None, caption=None, fetch=None):
         # Upload a file to Telegram in its own message.
-        # Prefer a source URL if available, else fall back to re-uploading the file.
+        # Prefer a source URL if available, else fall back to re-uploading the file.  A prefetched
+        # response can only be streamed once, so fallback uploads will fetch the file again.
         base = {"chat_id": str(chat)}
         if reply_to:
             base.update({"reply_to_message_id": reply_to,
@@ -1471,25 +1975,24 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
             base["caption"] = text
             base["parse_mode"] = "HTML"
         if attach.type == immp.File.Type.image:
-            data = await self._form_data(base, "photo", attach)
             try:
-                return await self._api("sendPhoto", _Schema.message, data=data)
+                return await self._send_file("sendPhoto", "photo", base, attach, fetch)
             except (TelegramAPIConnectError, TelegramAPIRequestError):
                 log.debug("Failed to upload image, falling back to document upload")
+            fetch = None
         elif attach.type == immp.File.Type.video:
-            data = await self._form_data(base, "video", attach)
             try:
-                return await self._api("sendVideo", _Schema.message, data=data)
+                return await self._send_file("sendVideo", "video", base, attach, fetch)
             except (TelegramAPIConnectError, TelegramAPIRequestError):
                 log.debug("Failed to upload video, falling back to document upload")
-        data = await self._form_data(base, "document", attach)
+            fetch = None
         try:
-            return await self._api("sendDocument", _Schema.message, data=data)
+            return await self._send_file("sendDocument", "document", base, attach, fetch)
         except TelegramAPIConnectError as e:
             log.warning("Failed to upload file", exc_info=e)
             return None
 
-    def _requests(self, chat, msg):
+    def _requests(self, chat, msg, fetches):
         reply_to = ""
         quote = False
         rich = None
@@ -1515,13 +2018,14 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
         primary = None
         if len(captionable) == 1 and fits_caption:
             primary = captionable[0]
-            requests.append(self._upload_attachment(chat, msg, primary, reply_to, rich))
+            requests.append(self._upload_attachment(chat, msg, primary, reply_to, rich,
+                                                    self._prefetch(primary, fetches)))
         elif rich:
             for chunk in rich.chunked(4096):
                 text = "".join(TelegramSegment.to_html(self, segment) for segment in chunk)
                 # Prevent linked user names generating link previews.
                 no_link_preview = "true" if msg.user and msg.user.link else "false"
-                requests.append(self._api("sendMessage", _Schema.message,
+                requests.append(self._api("sendMessage", _Schema.message, chat=chat,
                                           params={"chat_id": chat,
                                                   "text": text,
                                                   "parse_mode": "HTML",
@@ -1533,9 +2037,10 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
             if attach is primary:
                 continue
             elif isinstance(attach, immp.File):
-                requests.append(self._upload_attachment(chat, msg, attach))
+                requests.append(self._upload_attachment(chat, msg, attach,
+                                                        fetch=self._prefetch(attach, fetches)))
             elif isinstance(attach, immp.Location):
-                requests.append(self._api("sendLocation", _Schema.message,
+                requests.append(self._api("sendLocation", _Schema.message, chat=chat,
                                           params={"chat_id": chat,
                                                   "latitude": str(attach.latitude),
                                                   "longitude": str(attach.longitude)}))
@@ -1543,7 +2048,7 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
                     caption = immp.Message(user=msg.user, text="sent a location", action=True)
                     text = "".join(TelegramSegment.to_html(self, segment)
                                    for segment in caption.render())
-                    requests.append(self._api("sendMessage", _Schema.message,
+                    requests.append(self._api("sendMessage", _Schema.message, chat=chat,
                                               params={"chat_id": chat,
                                                       "text": text,
                                                       "parse_mode": "HTML"}))
@@ -1555,31 +2060,47 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
             log.debug("Following chat migration: %r -> %r", chat, self._migrations[chat])
             chat = self._migrations[chat]
         requests = []
+        fetches = []
         for attach in msg.attachments:
             # Generate requests for attached messages first.
             if isinstance(attach, immp.Receipt):
                 # Forward the messages natively using the given chat/ID.
                 forward_chat, forward_id = map(int, attach.id.split(":", 1))
-                requests.append(self._api("forwardMessage", _Schema.message,
+                requests.append(self._api("forwardMessage", _Schema.message, chat=chat,
                                           params={"chat_id": chat,
                                                   "from_chat_id": forward_chat,
                                                   "message_id": forward_id}))
             elif isinstance(attach, immp.Message):
-                requests += self._requests(chat, attach)
-        own_requests = self._requests(chat, msg)
+                requests += self._requests(chat, attach, fetches)
+        own_requests = self._requests(chat, msg, fetches)
         if requests and not own_requests and msg.user:
             # Forwarding a message but no content to show who forwarded it.
             info = immp.Message(user=msg.user, action=True, text="forwarded a message")
-            own_requests = self._requests(chat, info)
+            own_requests = self._requests(chat, info, fetches)
         requests += own_requests
+        # Requests must be made one at a time to preserve their order in the chat, but parsing of
+        # each response can happen in the background whilst the next request is in flight.
+        parsing = []
         receipts = []
-        for request in requests:
-            result = await request
-            if not result:
-                continue
-            sent = await TelegramMessage.from_bot_message(self, result)
-            receipts.append(sent)
-            self._post_recv(sent)
+        try:
+            for request in requests:
+                result = await request
+                if result:
+                    parsing.append(ensure_future(TelegramMessage.from_bot_message(self, result)))
+            for sent in await gather(*parsing):
+                receipts.append(sent)
+                self._post_recv(sent)
+        finally:
+            for request in requests:
+                # Discard any requests not yet made if an earlier one failed.
+                request.close()
+            for task in parsing:
+                task.cancel()
+            for fetch in fetches:
+                if not fetch.done():
+                    fetch.cancel()
+                elif not fetch.cancelled() and not fetch.exception():
+                    fetch.result().release()
         return receipts
 
     async def delete(self, sent):
@@ -1597,10 +2118,26 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
     def _post_recv(self, sent):
         self.queue(sent)
         chat, seq = (int(part) for part in sent.id.split(":", 1))
-        if self._blacklist:
+        if chat in self._blacklist:
             self._blacklist.discard(chat)
+            self._state.set("blacklist", sorted(self._blacklist))
         if not str(chat).startswith("-100"):
             self._last_id = seq
+        if chat > 0 and sent.user:
+            # The user may have just started a conversation with us.
+            self.channel_for_user.invalidate(sent.user)
+        if sent.joined or sent.left:
+            try:
+                members = self._members[str(chat)]
+            except KeyError:
+                pass
+            else:
+                for user in sent.joined:
+                    if user and not _HiddenSender.has(int(user.id)):
+                        members[user.id] = user
+                for user in sent.left:
+                    if user:
+                        members.pop(user.id, None)
 
     async def _poll(self):
         while not self._closing:
@@ -1640,6 +2177,7 @@ class TelegramPlug(immp.Plug, immp.HTTPOpenable):
                 else:
                     log.debug("Ignoring update with unknown keys: %s", ", ".join(update.keys()))
                 self._offset = max(update["update_id"] + 1, self._offset)
+            self._save_state()
 
     async def _handle_raw(self, event):
         log.debug("Received a %s event", event.__class__.__qualname__)